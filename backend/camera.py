@@ -0,0 +1,93 @@
+# camera.py
+# In charge of keeping the PiCamera open and continuously
+# capturing frames into a small ring of preallocated buffers
+
+# Libraries
+import threading
+import time
+
+import numpy as np
+
+
+# Shared Camera Class
+# Keeps a single PiCamera open for the lifetime of the client, so the 2s
+# warm-up is only paid once and queue threads no longer fight over the camera
+# Frames are captured into a ring of preallocated buffers, the latest frame
+# is handed out by reference (no copy)
+class Camera:
+    def __init__(self, resolution=(320, 240), framerate=24, buffers=4, captureInterval=0.5):
+        self.width, self.height = resolution
+        self.framerate = framerate
+        self.captureInterval = captureInterval  # Seconds between captured frames
+
+        # Ring of preallocated frame buffers
+        self.frames = [np.empty((self.height * self.width * 3,), dtype=np.uint8) for _ in range(buffers)]
+        self.latestIndex = -1
+        self.frameCount = 0
+
+        self.condition = threading.Condition()
+        self.thread = None
+
+    # Start the capture thread
+    def start(self):
+        if self.thread is not None:
+            return
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Get the latest frame, as a (height, width, 3) BGR view into the ring buffer
+    # The frame may be old if capture failed since, use getNewFrame() to only get fresh frames
+    # NOTE: The buffer is reused after len(self.frames) - 1 more captures,
+    # consumers should cut / copy the frame before then
+    def getFrame(self, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.latestIndex >= 0, timeout):
+                return None
+
+            return self.frames[self.latestIndex].reshape((self.height, self.width, 3))
+
+    # Wait for a frame newer than frameCount, returns (frameCount, frame)
+    def getNewFrame(self, frameCount, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.frameCount > frameCount, timeout):
+                return frameCount, None
+
+            return self.frameCount, self.frames[self.latestIndex].reshape((self.height, self.width, 3))
+
+    # Yield the next free buffer to the camera, publishing the previous one once it is filled
+    def _buffers(self):
+        index = 0
+        while True:
+            yield self.frames[index]
+
+            # Camera only asks for the next buffer once the previous one is filled
+            with self.condition:
+                self.latestIndex = index
+                self.frameCount += 1
+                self.condition.notify_all()
+
+            index = (index + 1) % len(self.frames)
+
+            if self.captureInterval > 0:
+                time.sleep(self.captureInterval)
+
+    # Capture thread, reopens the camera if it fails
+    def _run(self):
+        while True:
+            try:
+                import picamera
+
+                with picamera.PiCamera() as camera:
+                    camera.resolution = (self.width, self.height)
+                    camera.framerate = self.framerate
+                    time.sleep(2)  # Camera warm-up, only done once
+
+                    print("[INFO] Camera started")
+                    camera.capture_sequence(self._buffers(), 'bgr', use_video_port=True)
+            except Exception as e:
+                print("[ERROR] Camera capture failed!")
+                print("Error Log: " + str(e))
+                print("Recovering...")
+                time.sleep(5)
@@ -6,18 +6,28 @@
 import argparse
 import sys
 
-import torch
 import cv2
 import numpy as np
-import picamera
-import math
 
 import threading
 import time
 import logging
 import os
 
-import socket
+from camera import Camera
+from connection import Connection
+from protocol import format_wait
+from warp import Warp
+from inference import BACKENDS, ModelLoader
+from motion import MotionGate
+from polygon import HEAD_CLASS, count_in_polygons
+from scheduler import Scheduler, parse_hours
+from tracker import Tracker
+import tracing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../misc"))
+import metrics
+from registry import RegistryError, load_registry
 
 print("Starting script...")
 
@@ -31,11 +41,46 @@ parser.add_argument('--debug', default=False, action="store_true", help='Turns o
 parser.add_argument('--image_debug', default=False, action="store_true", help='Turns on image debugging')
 parser.add_argument('--ip', type=str, default="127.0.0.1", help='IP Address of Socket Server')
 parser.add_argument('--port', type=int, default=6942, help='Port of Socket Server')
-args = parser.parse_args()
+parser.add_argument('--protocol', type=str, default="binary", choices=["binary", "text"], help='Wire protocol, text for the original server, one "password|stall|time" report per connection')
+mode = parser.add_mutually_exclusive_group()
+mode.add_argument('--batch', default=False, action="store_true", help='Runs inference for all queues in a single batched call')
+mode.add_argument('--full_frame', default=False, action="store_true", help='Runs inference once on the full camera frame and assigns detections to queues by their cut positions')
+mode.add_argument('--track', default=False, action="store_true", help='Runs inference only on keyframes and tracks heads in between')
+parser.add_argument('--keyframe_interval', type=int, default=10, help='Frames between detector keyframes in tracking mode')
+parser.add_argument('--track_interval', type=float, default=0.5, help='Seconds between tracked frames in tracking mode')
+parser.add_argument('--anchor', type=str, default="head", choices=["head", "foot"], help='Point of a detection used to assign it to a queue in full frame mode')
+parser.add_argument('--backend', type=str, default="torch", choices=BACKENDS, help='Inference engine to run the model on')
+parser.add_argument('--model', type=str, default=None, help='Path to the model file for the chosen backend (see export_model.py)')
+parser.add_argument('--yolov5_dir', type=str, default=os.path.join(os.path.dirname(__file__), "yolov5"), help='Local yolov5 checkout, used to load the torch model offline')
+parser.add_argument('--warp_cache', type=str, default=None, help='Directory to cache perspective remap tables in')
+parser.add_argument('--motion_threshold', type=float, default=0.0, help='Fraction of changed pixels needed to run inference again, 0 to always run inference')
+parser.add_argument('--motion_max_age', type=float, default=300, help='Seconds before inference is forced even if the scene has not changed')
+parser.add_argument('--adaptive', default=False, action="store_true", help='Samples busy queues more often and empty queues less often, instead of every 30 seconds')
+parser.add_argument('--min_interval', type=float, default=5, help='Shortest time between samples of a queue in adaptive mode')
+parser.add_argument('--max_interval', type=float, default=300, help='Longest time between samples of a queue in adaptive mode')
+parser.add_argument('--max_inferences_per_minute', type=float, default=12, help='Cap on inferences per minute across all queues in adaptive mode')
+parser.add_argument('--cpu_budget', type=float, default=0.5, help='Fraction of a CPU core inference may use in adaptive mode')
+parser.add_argument('--peak_hours', type=str, default="11:00-14:00", help='Comma separated HH:MM-HH:MM windows sampled more often in adaptive mode')
+parser.add_argument('--registry', type=str, default=None, help='Stall registry file, misc/stalls.json by default')
+parser.add_argument('--canteen', type=str, default=None, help='Canteen of the stalls this Pi is in charge of, the first one in the registry by default')
+parser.add_argument('--stalls', type=str, default=None, help='Comma separated stalls this Pi is in charge of, all stalls of the canteen with a polygon by default')
+parser.add_argument('--metrics_port', type=int, default=9101, help='Port to serve Prometheus metrics on, 0 to turn off')
+parser.add_argument('--metrics_host', type=str, default="127.0.0.1", help='Address to serve Prometheus metrics on, 0.0.0.0 for remote scraping')
+parser.add_argument('--trace', default=False, action="store_true", help='Records per cycle spans and dumps them in the Chrome trace format, SIGUSR1 profiles queue threads')
+parser.add_argument('--trace_dir', type=str, default=os.path.join(os.path.dirname(__file__), "traces"), help='Directory to write traces and profiles to')
+parser.add_argument('--trace_interval', type=float, default=30, help='Seconds between trace dumps')
+parser.add_argument('--trace_size', type=int, default=10000, help='Spans kept per thread in trace mode')
+parser.add_argument('--profile_seconds', type=float, default=10, help='Seconds every queue thread is profiled for on SIGUSR1 in trace mode')
+parser.add_argument('--capture_interval', type=float, default=0.5, help='Seconds between frames captured by the camera')
+args = parser.parse_args(None if __name__ == "__main__" else [])  # Defaults when imported, e.g. by benchmarks
 
 # Variables
 debug = args.debug
 image_debug = args.image_debug
+batch = args.batch
+full_frame = args.full_frame
+track = args.track
+confidence_threshold = args.confidence_threshold
 
 server_ip = args.ip
 server_port = args.port
@@ -58,16 +103,54 @@ except KeyError:
 
 W, H = 640, 640   # Width and height of cut image
 
-interval = 30     # Seconds before running program again
+interval = 30     # Seconds before running program again, unless adaptive
 
+# Stalls this Pi is in charge of, from the stall registry
+# NOTE: Polygons are unique for every raspberry pi, depending on where its camera points
 try:
-    model = torch.hub.load("ultralytics/yolov5", "custom", path="crowdhuman_yolov5m.pt")
-except:
-    print("[FATAL] Failed to load model!")
-    print("[INFO]  Check if yolo_v5 crowdhuman is downloaded!")
-    print("[INFO]  Link: https://drive.google.com/u/2/uc?id=1gglIwqxaH2iTvy6lZlXuAcMpd_U0GCUb&export=download&confirm=t")
+    registry = load_registry(args.registry)
+except RegistryError as e:
+    print("[FATAL] " + str(e))
     sys.exit(1)
 
+canteen = args.canteen or registry.defaultCanteen
+if registry.stalls(canteen) is None:
+    print("[FATAL] Unknown canteen: " + canteen)
+    sys.exit(1)
+
+if args.stalls:
+    stalls = [registry.stall(canteen, name.strip()) for name in args.stalls.split(",")]
+    if None in stalls or not all(stall.polygon for stall in stalls):
+        print("[FATAL] Stalls must be in the registry, with a polygon: " + args.stalls)
+        sys.exit(1)
+else:
+    stalls = [stall for stall in registry.stalls(canteen) if stall.polygon]
+
+# Adaptive sampling scheduler
+scheduler = None
+if args.adaptive:
+    scheduler = Scheduler(args.min_interval, args.max_interval, args.max_inferences_per_minute, args.cpu_budget, peakHours=parse_hours(args.peak_hours))
+
+camera = None     # Shared camera, started in main()
+picture_timeout = 10  # Seconds a queue thread waits for a new frame before its cycle fails
+last_frames = threading.local()  # Count of the last frame taken, per queue thread
+
+# Persistent connection to socket server, started in main()
+connection = Connection(server_ip, server_port, password, {stall.name: stall for stall in stalls}, binary=args.protocol == "binary", debug=debug)
+
+# Model is loaded and warmed up in the background, started in main()
+model = ModelLoader(args.backend, args.model, yolov5Dir=args.yolov5_dir, warmupShape=(H, W, 3))
+
+# Metrics, served on --metrics_port from main()
+stage_seconds = metrics.Histogram("client_stage_seconds", "Seconds spent per stage of a cycle", ("stage",))
+cycles = metrics.Counter("client_cycles_total", "Cycles run, per stall", ("stall",))
+skipped_inferences = metrics.Counter("client_skipped_inferences_total", "Inferences skipped as the image had not changed, per stall", ("stall",))
+missed_intervals = metrics.Counter("client_missed_intervals_total", "Cycles that took longer than their interval, per stall", ("stall",))
+failed_cycles = metrics.Counter("client_failed_cycles_total", "Cycles that failed with an error")
+metrics.Counter("client_reports_sent_total", "Reports sent to the socket server", function=lambda: connection.sent)
+metrics.Counter("client_reports_acked_total", "Reports ACKed by the socket server", function=lambda: connection.acked)
+metrics.Counter("client_reconnects_total", "Connections to the socket server dropped", function=lambda: connection.reconnects)
+
 # Canteen Queue Class
 # Class for each single canteen stall
 # Contains stall queue time (integer), Stall Name (string)
@@ -79,6 +162,16 @@ class Queue:
         self.image = None
         self.imageCutPositions = imageCutPositions
 
+        # Perspective remap table, built once as imageCutPositions never changes
+        self.warp = Warp(imageCutPositions, W, H, cacheDir=args.warp_cache)
+
+        # Change detection, skips inference when the CUT image has not changed
+        self.gate = MotionGate(args.motion_threshold, args.motion_max_age) if args.motion_threshold > 0 else None
+        self.lastCount = None
+
+        # Head tracker, used in tracking mode to count between keyframes and measure dwell time
+        self.tracker = Tracker() if track else None
+
     # Function to cut image and flatten with 4 specified points (imageCutPositions)
     def cutImage(self):
         if image_debug:
@@ -87,35 +180,119 @@ class Queue:
             self.image = cv2.imread(img_path)
             return
 
-        img = self.image
-
-        # Define corresponding points in input image
-        pts0 = np.float32(self.imageCutPositions)
-
-        # Define corresponding points in output image
-        pts1 = np.float32([[0,0],[W,0],[W,H],[0,H]])
+        with stage_seconds.time("cut"), tracing.span("warp"):
+            self.image = self.warp.apply(self.image)
 
-        # Get perspective transform and apply it
-        M = cv2.getPerspectiveTransform(pts0, pts1)
-        image = cv2.warpPerspective(img, M, (W, H))
+    # Function to check if the CUT image changed enough since the last count to need inference
+    # The gate is checked even without a count yet, so it keeps the first image as its reference
+    def hasChanged(self):
+        if self.gate is None:
+            return True
 
-        self.image = image
+        changed = self.gate.check(self.image)
+        return changed or self.lastCount is None
 
     # Function to count num of people in CUT image, using YOLOv5 alogrithm
     def countPeople(self):
-        results = model(self.image)
-        person_count = list(results.xyxyn[0][:,-1].numpy()).count(1.0)
-        return person_count
+        self.detectHeads()
+        return self.lastCount
+
+    # Function to get head boxes (xyxy, pixels) in CUT image, using YOLOv5 alogrithm
+    def detectHeads(self):
+        acquire_inference()
+        start_time = time.time()
+
+        detections = model.infer([self.image])[0]
+        heads = detections[(detections[:, 5] == HEAD_CLASS) & (detections[:, 4] >= confidence_threshold)]
+        self.lastCount = len(heads)
+
+        record_counts([self], time.time() - start_time)
+        stage_seconds.observe(time.time() - start_time, "count")
+
+        height, width = self.image.shape[:2]
+        return heads[:, :4] * np.float32([width, height, width, height])
+
+    # Function to get queue time based on number of ppl in secs
+    # Uses the time per person measured by the tracker when there is one, instead of queueTime per person
+    def getWaitSeconds(self, people_count):
+        person_time = self.tracker.personTime() if self.tracker is not None else None
+        if person_time is None:
+            person_time = self.queueTime
+
+        return people_count * person_time
 
     # Function to get queue time based on number of ppl in mins
     def getQueueTime(self, people_count):
-        secs = people_count * self.queueTime
-        approx_mins = secs / 60
+        return format_wait(self.getWaitSeconds(people_count))
+
+
+# Count number of heads (class 1) above the confidence threshold in a YOLOv5 detection array
+def count_heads(detections):
+    return int(np.count_nonzero((detections[:, 5] == HEAD_CLASS) & (detections[:, 4] >= confidence_threshold)))
+
+
+# Count num of people in the CUT images of several queues with a single batched inference
+# Queues whose image has not changed reuse their last count
+# Returns a list of counts, in the same order as queues
+def count_people_batch(queues):
+    changed = [queue for queue in queues if queue.hasChanged()]
+    for queue in queues:
+        if queue not in changed:
+            skipped_inferences.inc(queue.stallName)
+
+    if changed:
+        acquire_inference()
+        start_time = time.time()
+
+        results = model.infer([queue.image for queue in changed])
+        for queue, detections in zip(changed, results):
+            queue.lastCount = count_heads(detections)
+
+        record_counts(changed, time.time() - start_time)
+        stage_seconds.observe(time.time() - start_time, "count")
+
+    debug_print(f"[DEBUG] Ran inference for {len(changed)} of {len(queues)} queues")
+    return [queue.lastCount for queue in queues]
+
+
+# Count num of people in every queue from a single inference on the FULL image
+# Detections are assigned to queues by testing their anchor point against every queue's imageCutPositions
+# Returns a list of counts, in the same order as queues
+# The caller must hold an inference token (acquire_inference) before taking the picture
+def count_people_full_frame(queues, image, polygons):
+    start_time = time.time()
+
+    detections = model.infer([image])[0]
+    height, width = image.shape[:2]
+
+    counts = count_in_polygons(detections, polygons, width, height, confidence_threshold, anchor=args.anchor)
+    for queue, count in zip(queues, counts):
+        queue.lastCount = int(count)
+
+    record_counts(queues, time.time() - start_time)
+    stage_seconds.observe(time.time() - start_time, "count")
+    return [queue.lastCount for queue in queues]
 
-        if approx_mins < 1.0:
-            return 0.9
-        else:
-            return "~" + str(math.ceil(approx_mins))
+
+# Wait for the scheduler to allow another inference
+def acquire_inference():
+    if scheduler is not None:
+        scheduler.acquire()
+
+
+# Record new counts of queues that shared one inference with the scheduler
+def record_counts(queues, inference_time):
+    if scheduler is not None:
+        for queue in queues:
+            scheduler.record(queue.stallName, queue.lastCount, inference_time / len(queues))
+
+
+# Get seconds between samples of queues handled together
+def get_interval(queues):
+    if scheduler is None:
+        return interval
+
+    return min(scheduler.nextInterval(queue.stallName) for queue in queues)
 
 
 # Print in debug mode
@@ -124,29 +301,65 @@ def debug_print(msg):
         print(msg)
 
 
+# Get a picture from the shared camera, newer than the last one this thread took
+# Raises if the camera delivers none in time, so a failed capture is not counted again as fresh
+def take_picture():
+    with stage_seconds.time("capture"), tracing.span("camera"):
+        frame_count, image = camera.getNewFrame(getattr(last_frames, "count", 0), picture_timeout)
+
+    if image is None:
+        raise RuntimeError(f"No new camera frame for {picture_timeout} seconds")
+
+    last_frames.count = frame_count
+    return image
+
+
+# Count a finished cycle of queues, and whether it took longer than its interval
+def record_cycle(queues, seconds, queue_interval):
+    tracing.record("cycle", seconds)
+
+    for queue in queues:
+        cycles.inc(queue.stallName)
+        if seconds > queue_interval:
+            missed_intervals.inc(queue.stallName)
+
+
+# Run a queue handling loop in a thread, starting it again if a cycle fails with an error
+def run_handler(handler, *handler_args):
+    while True:
+        try:
+            handler(*handler_args)
+        except Exception as e:
+            failed_cycles.inc()
+            print("[ERROR] Queue handling failed!")
+            print("Error Log: " + str(e))
+            time.sleep(5)
+
+
+# Queue queue time of a queue to be sent to server over the shared connection
+def send_queue_time(queue, people_count):
+    send_queue_times([queue], [people_count])
+
+
+# Queue queue times of several queues to be sent to server together
+def send_queue_times(queues, people_counts):
+    with stage_seconds.time("send"), tracing.span("send"):
+        reports = [(queue.stallName, people_count, queue.getWaitSeconds(people_count)) for queue, people_count in zip(queues, people_counts)]
+        debug_print("[DEBUG] Sending data: " + str(reports))
+        connection.sendAll(reports)
+
+
 # Queue Handling Thread
 def handle_queue(queue):
     """ Repeatedly take pictures of the queue, count the number of people and send to server """
     while True:
+        tracing.profile_point()
+
         debug_print("[DEBUG] Reading queue image...")
 
         # Take picture
         if not image_debug:
-            with picamera.PiCamera() as camera:
-                camera.resolution = (320, 240)
-                camera.framerate = 24
-                time.sleep(2)
-                image = np.empty((240 * 320 * 3,), dtype=np.uint8)
-                camera.capture(image, 'bgr')
-                image = image.reshape((240, 320, 3))
-
-                # ret, frame = cam.read()
-                # if not ret:  # Handle camera failing to take picture
-                #     time.sleep(5)
-                #     continue
-
-                # Save picture
-                queue.image = image
+            queue.image = take_picture()
 
         # Crop image
         queue.cutImage()
@@ -154,67 +367,228 @@ def handle_queue(queue):
         # Get start time
         start_time = time.time()
 
-        # Get number of people in image
-        debug_print("[DEBUG] Counting people...")
-        people_count = queue.countPeople()
+        # Get number of people in image, reusing last count if the image has not changed
+        if queue.hasChanged():
+            debug_print("[DEBUG] Counting people...")
+            people_count = queue.countPeople()
+        else:
+            debug_print("[DEBUG] Image unchanged, reusing last count...")
+            skipped_inferences.inc(queue.stallName)
+            people_count = queue.lastCount
 
-        # Connect to server and send data
-        # Connect to server
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            debug_print("[DEBUG] Socket Created!")
-        except socket.error as error:
-            print("[FATAL] Error while creating Socket!")
-            print("Error Log: " + str(error))
-            print("Recovering...")
-            time.sleep(10)
-            continue
+        # Send data to server
+        send_queue_time(queue, people_count)
 
-        try:
-            sock.connect((server_ip, server_port))
-            debug_print(f"[DEBUG] Connected to {server_ip}:{server_port}")
-        except socket.error as error:
-            print("[FATAL] Error while connecting to server!")
-            print("Error Log: " + str(error))
-            print("Recovering...")
-            time.sleep(10)
-            continue
-
-        queue_time = queue.getQueueTime(people_count)
-
-        # Send data
-        data = password + "|" + queue.stallName + "|" + str(queue_time)
-        debug_print("[DEBUG] Sending data: " + data)
-        sock.send(data.encode())
-
-        # Wait for server to send back ACK and close socket
-        sock.recv(1024)
-        sock.close()
-        debug_print(f"[DEBUG] ACK Received, waiting for {interval} seconds...")
+        queue_interval = get_interval([queue])
+        record_cycle([queue], time.time() - start_time, queue_interval)
+        debug_print(f"[DEBUG] Data queued, waiting for {queue_interval:.0f} seconds...")
+
+        # Wait for interval
+        if time.time() - start_time < queue_interval:
+            time.sleep(queue_interval - (time.time() - start_time))
+
+
+# Tracked Queue Handling Thread
+def handle_queue_tracked(queue):
+    """ Take pictures of the queue often, detect heads on keyframes and track them in between, sending the tracked count to server """
+    frame = 0
+    last_sent = 0
+
+    while True:
+        tracing.profile_point()
+
+        start_time = time.time()
+
+        # Take picture
+        if not image_debug:
+            queue.image = take_picture()
+
+        # Crop image
+        queue.cutImage()
+
+        # Detect on keyframes, track in between
+        now = time.monotonic()
+        if frame % args.keyframe_interval == 0:
+            debug_print("[DEBUG] Keyframe, counting people...")
+            queue.tracker.update(queue.detectHeads(), queue.image, now)
+        else:
+            queue.tracker.propagate(queue.image, now)
+
+        frame += 1
+        people_count = queue.tracker.count()
+        queue.lastCount = people_count
+
+        # Send data to server, every interval
+        if now - last_sent >= get_interval([queue]):
+            send_queue_time(queue, people_count)
+
+            last_sent = now
+            debug_print(f"[DEBUG] Data queued, {people_count} people tracked, dwell time {queue.tracker.dwellTime()}, time per person {queue.tracker.personTime()}")
+
+        record_cycle([queue], time.time() - start_time, args.track_interval)
+
+        # Wait for next tracked frame
+        if time.time() - start_time < args.track_interval:
+            time.sleep(args.track_interval - (time.time() - start_time))
+
+
+# Batched Queue Handling Thread
+def handle_queues_batched(queues):
+    """ Take a single picture for all queues, count the people in every queue in one inference and send to server """
+    while True:
+        tracing.profile_point()
+
+        debug_print("[DEBUG] Reading queue image...")
+
+        # Take a single picture and share it between all queues
+        if not image_debug:
+            image = take_picture()
+            for queue in queues:
+                queue.image = image
+
+        # Crop image for every queue
+        for queue in queues:
+            queue.cutImage()
+
+        # Get start time
+        start_time = time.time()
+
+        # Get number of people in every queue
+        debug_print(f"[DEBUG] Counting people in {len(queues)} queues...")
+        people_counts = count_people_batch(queues)
+
+        # Send data for every queue to server, together
+        send_queue_times(queues, people_counts)
+
+        queue_interval = get_interval(queues)
+        record_cycle(queues, time.time() - start_time, queue_interval)
+        debug_print(f"[DEBUG] Batch sent, waiting for {queue_interval:.0f} seconds...")
 
         # Wait for interval
-        if time.time() - start_time < interval:
-            time.sleep(interval - (time.time() - start_time))
+        if time.time() - start_time < queue_interval:
+            time.sleep(queue_interval - (time.time() - start_time))
+
+
+# Full Frame Queue Handling Thread
+def handle_queues_full_frame(queues):
+    """ Take a single picture for all queues, count the people in the whole picture once and assign them to queues """
+    polygons = np.float32([queue.imageCutPositions for queue in queues])
+
+    while True:
+        tracing.profile_point()
+
+        # Get start time
+        start_time = time.time()
+
+        # Wait for an inference token first, the picture is a view into the camera ring
+        # that is overwritten within a few frames, so it must be used as soon as it is taken
+        acquire_inference()
+
+        debug_print("[DEBUG] Reading full image...")
+
+        # Take picture
+        if image_debug:
+            image = cv2.imread(os.path.join(os.path.dirname(__file__), "../testing/queue_2.jpg"))
+        else:
+            image = take_picture()
+
+        # Get number of people in every queue
+        debug_print(f"[DEBUG] Counting people in {len(queues)} queues...")
+        people_counts = count_people_full_frame(queues, image, polygons)
+
+        # Send data for every queue to server, together
+        send_queue_times(queues, people_counts)
+
+        queue_interval = get_interval(queues)
+        record_cycle(queues, time.time() - start_time, queue_interval)
+        debug_print(f"[DEBUG] Full frame sent, waiting for {queue_interval:.0f} seconds...")
+
+        # Wait for interval
+        if time.time() - start_time < queue_interval:
+            time.sleep(queue_interval - (time.time() - start_time))
 
 
 # Main Function
 def main():
     # List of queues a Pi is supposed to handle
-    # TODO: Add queues into this list
-    # NOTE: This list is unique for every raspberry pi, depending on the stores it's in charge of
-    queues = [Queue("Drinks", 120, [[0,0],[650, 0],[650,400],[0,500]])]
+    queues = [Queue(stall.name, stall.serviceTime, stall.polygon) for stall in stalls]
+    if not queues:
+        print("[FATAL] No stalls to handle, add polygons to the registry or pass --stalls")
+        sys.exit(1)
+
+    # Start shared camera, kept open for all queue threads
+    global camera
+    if not image_debug:
+        try:
+            import picamera
+        except ImportError as e:
+            print("[FATAL] Camera module not available!")
+            print("Error Log: " + str(e))
+            sys.exit(1)
 
-    # Loop through queues and start queue handling thread
-    for queue in queues:
-        debug_print("[DEBUG] Starting queue handling thread...")
-        thread = threading.Thread(target=handle_queue, args=(queue,))
+        camera = Camera(resolution=(320, 240), framerate=24, captureInterval=args.capture_interval)
+        camera.start()
+
+    # Start loading model, while the camera warms up
+    model.start()
+
+    # Start connection to server
+    connection.start()
+
+    # Serve metrics
+    if args.metrics_port:
+        try:
+            metrics.start_server(args.metrics_port, args.metrics_host)
+        except OSError as e:
+            print("[ERROR] Failed to start metrics server!")
+            print("Error Log: " + str(e))
+
+    # Record traces
+    if args.trace:
+        tracing.start(args.trace_dir, args.trace_interval, args.trace_size)
+        tracing.install_profile_signal(args.profile_seconds)
+        print(f"[INFO] Tracing to {args.trace_dir}, send SIGUSR1 to profile queue threads")
+
+    # Start a single thread handling all queues in full frame mode
+    if full_frame:
+        debug_print("[DEBUG] Starting full frame queue handling thread...")
+        thread = threading.Thread(target=run_handler, args=(handle_queues_full_frame, queues), name="full frame")
         thread.daemon = True
         thread.start()
 
-    # Loop forever
+    # Start a single thread handling all queues in batched mode
+    elif batch:
+        debug_print("[DEBUG] Starting batched queue handling thread...")
+        thread = threading.Thread(target=run_handler, args=(handle_queues_batched, queues), name="batched")
+        thread.daemon = True
+        thread.start()
+
+    # Loop through queues and start queue handling thread
+    else:
+        for queue in queues:
+            debug_print("[DEBUG] Starting queue handling thread...")
+            thread = threading.Thread(target=run_handler, args=(handle_queue_tracked if track else handle_queue, queue), name=queue.stallName)
+            thread.daemon = True
+            thread.start()
+
+    # Wait for model, queue threads block on it until it is ready
+    if not model.wait():
+        print("[FATAL] Failed to load model!")
+        print("Error Log: " + str(model.error))
+        print("[INFO]  Check if yolo_v5 crowdhuman is downloaded!")
+        print("[INFO]  Link: https://drive.google.com/u/2/uc?id=1gglIwqxaH2iTvy6lZlXuAcMpd_U0GCUb&export=download&confirm=t")
+        print("[INFO]  Non torch backends need the model exported first with export_model.py")
+        print("[INFO]  Offline torch loading needs a yolov5 checkout in --yolov5_dir")
+        sys.exit(1)
+
+    # Loop forever, reporting inference skip rate
     while True:
         time.sleep(60)
 
+        for queue in queues:
+            if queue.gate is not None:
+                print(f"[INFO] {queue.stallName}: skipped {queue.gate.skips}/{queue.gate.checks} inferences ({queue.gate.skipRate():.0%})")
+
 
 # Run Code
 if __name__ == "__main__":
@@ -0,0 +1,312 @@
+# connection.py
+# In charge of keeping a single connection from the client
+# to the socket server, and sending queue time reports over it
+
+# Libraries
+import collections
+import itertools
+import os
+import socket
+import sys
+import threading
+import time
+
+import protocol
+import tracing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../misc"))
+import metrics
+
+# Metrics
+socket_send_seconds = metrics.Histogram("client_socket_send_seconds", "Seconds spent writing reports to the socket")
+ack_seconds = metrics.Histogram("client_ack_seconds", "Seconds from sending a report to its ACK")
+send_errors = metrics.Counter("client_send_errors_total", "Failed connects and sends to the socket server", ("stage",))
+
+
+# Server Connection Class
+# Reports are queued with send() and never block the caller
+# A sender thread keeps one socket open to the server, writes all reports that are due
+# together in one go and reconnects with exponential backoff when the connection drops
+# The backoff is only reset once a report is ACKed, so a server that closes every connection is not hammered
+# A reader thread matches ACKs to sent reports, so reports are pipelined instead of
+# waiting for an ACK each; unACKed reports are sent again after a reconnect, or when
+# a report is not ACKed within ackTimeout seconds, e.g. over a half-open link
+# Reports go over the binary protocol (protocol.py), or with binary=False the way the
+# original server takes them: a single "password|stall|time" report per connection, ACKed with "ACK"
+# stalls maps the stall names reports are queued under to their registry stalls, for the wire names and IDs
+class Connection:
+    def __init__(self, ip : str, port : int, password : str, stalls=None, binary=True, minBackoff=1, maxBackoff=30, ackTimeout=30, debug=False):
+        self.ip = ip
+        self.port = port
+        self.password = password
+        self.stalls = stalls or {}
+        self.binary = binary
+        self.minBackoff = minBackoff
+        self.maxBackoff = maxBackoff
+        self.ackTimeout = ackTimeout
+        self.debug = debug
+
+        self.outbox = {}                            # Stall name -> (people count, wait seconds), newest report wins
+        self.pending = collections.OrderedDict()    # Sequence number -> (stall name, report, time sent), sent and waiting for an ACK
+        self.seq = itertools.count(1)
+        self.sock = None
+        self.key = None                             # Session key of the binary protocol
+        self.backoff = 0                            # Seconds to wait before the next connect, 0 after an ACK
+        self.condition = threading.Condition()
+        self.thread = None
+
+        # Stats
+        self.sent = 0
+        self.acked = 0
+        self.reconnects = 0
+
+    def debug_print(self, msg):
+        if self.debug:
+            print(msg)
+
+    # Start the sender thread
+    def start(self):
+        if self.thread is not None:
+            return
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Queue a report for a stall
+    def send(self, stallName : str, peopleCount : int, waitSecs : float):
+        self.sendAll([(stallName, peopleCount, waitSecs)])
+
+    # Queue reports of (stall name, people count, wait seconds) that are due together, so they are sent in one go
+    def sendAll(self, reports):
+        with self.condition:
+            for stallName, peopleCount, waitSecs in reports:
+                self.outbox[stallName] = (peopleCount, waitSecs)
+            self.condition.notify_all()
+
+    # Wait for every queued report to be ACKed, returns False on timeout
+    def flush(self, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.outbox and not self.pending, timeout)
+
+    # Read from a blocking socket until a frame arrives
+    # The server only sends one frame per handshake step, so nothing is left buffered
+    def _readFrame(self, sock, decoder):
+        while True:
+            data = sock.recv(1024)
+            if not data:
+                raise protocol.ProtocolError("Connection closed during handshake")
+
+            frames = decoder.feed(data)
+            if frames:
+                return frames[0]
+
+    # Authenticate a new binary protocol connection, returns the session key
+    def _handshake(self, sock, decoder):
+        clientNonce = protocol.new_nonce()
+        sock.sendall(protocol.encode_frame(protocol.HELLO, clientNonce))
+
+        frameType, serverNonce = self._readFrame(sock, decoder)
+        if frameType != protocol.CHALLENGE or len(serverNonce) != protocol.NONCE_SIZE:
+            raise protocol.ProtocolError("Expected CHALLENGE")
+
+        sock.sendall(protocol.encode_frame(protocol.AUTH, protocol.auth_mac(self.password, clientNonce, serverNonce)))
+
+        frameType, _ = self._readFrame(sock, decoder)
+        if frameType != protocol.WELCOME:
+            raise protocol.ProtocolError("Authentication rejected by server")
+
+        return protocol.session_key(self.password, clientNonce, serverNonce)
+
+    # Connect to the server, retrying with exponential backoff
+    # Returns the socket, the binary protocol session key and frame decoder
+    def _connect(self):
+        while True:
+            if self.backoff:
+                time.sleep(self.backoff)
+            self.backoff = min(max(self.backoff * 2, self.minBackoff), self.maxBackoff)
+
+            sock = None
+            try:
+                sock = socket.create_connection((self.ip, self.port), timeout=10)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+                decoder = protocol.FrameDecoder()
+                key = self._handshake(sock, decoder) if self.binary else None
+
+                sock.settimeout(None)
+                self.debug_print(f"[DEBUG] Connected to {self.ip}:{self.port}")
+                return sock, key, decoder
+            except (socket.error, protocol.ProtocolError) as error:
+                if sock is not None:
+                    sock.close()
+
+                send_errors.inc("connect")
+
+                print("[ERROR] Error while connecting to server!")
+                print("Error Log: " + str(error))
+                print(f"Retrying in {self.backoff} seconds...")
+
+    # Time the oldest unACKed report was sent, None if every report is ACKed
+    def _oldestPending(self):
+        return next(iter(self.pending.values()))[2] if self.pending else None
+
+    # Drop a connection, queueing its unACKed reports again
+    # reconnect is False when the connection is done with, like after a text report is ACKed
+    def _disconnect(self, sock, reconnect=True):
+        with self.condition:
+            if self.sock is not sock:
+                return
+
+            self.sock = None
+            sock.close()
+
+            for stallName, report, _ in self.pending.values():
+                self.outbox.setdefault(stallName, report)  # Keep newer reports
+            self.pending.clear()
+
+            if reconnect:
+                self.reconnects += 1
+            self.condition.notify_all()
+
+    # Sender thread
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.outbox, self.ackTimeout / 4)
+                sock = self.sock
+                oldest = self._oldestPending()
+
+            # Nothing ACKed for too long, the link may be half-open, so send again over a new connection
+            if sock is not None and oldest is not None and time.monotonic() - oldest > self.ackTimeout:
+                send_errors.inc("ack_timeout")
+                print(f"[ERROR] No ACK from server for {self.ackTimeout} seconds, reconnecting...")
+                self._disconnect(sock)
+                continue
+
+            with self.condition:
+                if not self.outbox:
+                    continue
+
+            if sock is None:
+                sock, key, decoder = self._connect()
+                with self.condition:
+                    self.sock = sock
+                    self.key = key
+
+                reader = threading.Thread(target=self._read, args=(sock, decoder))
+                reader.daemon = True
+                reader.start()
+
+            # Take every report that is due, unless the connection dropped meanwhile
+            # Text reports go one per connection, the original server closes it after the ACK
+            with self.condition:
+                if self.sock is not sock:
+                    continue
+
+                reports = list(self.outbox.items())
+                if not self.binary:
+                    reports = reports[:1]
+                for stallName, _ in reports:
+                    del self.outbox[stallName]
+
+                data = b""
+                now = time.monotonic()
+                for stallName, report in reports:
+                    seq = next(self.seq)
+                    frame = self._encode(seq, stallName, report)
+                    if frame is not None:
+                        data += frame
+                        self.pending[seq] = (stallName, report, now)
+
+            self.debug_print(f"[DEBUG] Sending {len(reports)} reports")
+
+            try:
+                with socket_send_seconds.time(), tracing.span("socket", "connection"):
+                    sock.sendall(data)
+                self.sent += len(reports)
+            except socket.error as error:
+                send_errors.inc("send")
+                print("[ERROR] Error while sending to server!")
+                print("Error Log: " + str(error))
+                self._disconnect(sock)
+                continue
+
+            # Wait for the text report to be ACKed and its connection closed, or for the ACK timeout
+            if not self.binary:
+                with self.condition:
+                    self.condition.wait_for(lambda: self.sock is not sock, self.ackTimeout)
+
+    # Encode a report for the wire, None if it cannot be sent
+    def _encode(self, seq : int, stallName : str, report):
+        peopleCount, waitSecs = report
+        stall = self.stalls.get(stallName)
+
+        if not self.binary:
+            textName = stall.textName if stall is not None else stallName
+            return f"{self.password}|{textName}|{protocol.format_wait(waitSecs)}".encode()
+
+        if stall is None:
+            print("[ERROR] Unknown stall, not sent: " + stallName)
+            return None
+
+        return protocol.encode_report(self.key, stall.stallId, peopleCount, waitSecs, int(time.time()), seq)
+
+    # Reader thread, one per connection
+    def _read(self, sock, decoder):
+        buffer = b""
+
+        while True:
+            try:
+                data = sock.recv(1024)
+            except socket.error:
+                data = b""
+
+            if not data:
+                self._disconnect(sock)
+                return
+
+            # Binary ACKs carry the sequence number, a text connection carries a single report ACKed with "ACK"
+            # Binary reports the server rejects come back as ERROR frames, they are not sent again
+            acks = []
+            errors = []
+            if self.binary:
+                try:
+                    for frameType, payload in decoder.feed(data):
+                        if frameType == protocol.ACK_FRAME:
+                            acks.append(protocol.decode_ack(payload))
+                        elif frameType == protocol.ERROR:
+                            errors.append(protocol.decode_error(payload))
+                except protocol.ProtocolError as error:
+                    print("[ERROR] Bad frame from server: " + str(error))
+                    self._disconnect(sock)
+                    return
+            else:
+                buffer += data
+                if buffer.startswith(b"ACK"):
+                    acks.append(None)
+
+            with self.condition:
+                now = time.monotonic()
+                for seq in acks:
+                    if self.binary:
+                        entry = self.pending.pop(seq, None)
+                    else:
+                        entry = self.pending.popitem(last=False)[1] if self.pending else None
+
+                    if entry is not None:
+                        self.acked += 1
+                        self.backoff = 0
+                        ack_seconds.observe(now - entry[2])
+
+                for seq, reason in errors:
+                    entry = self.pending.pop(seq, None)
+                    send_errors.inc("rejected")
+                    print(f"[ERROR] Server rejected report for {entry[0] if entry else 'unknown stall'}: {reason}")
+
+                self.condition.notify_all()
+
+            # The text report of this connection is done with
+            if acks and not self.binary:
+                self._disconnect(sock, reconnect=False)
+                return
@@ -0,0 +1,96 @@
+# export_model.py
+# In charge of converting crowdhuman_yolov5m.pt once into
+# the TorchScript, ONNX and INT8 ONNX models used by inference.py
+
+# Libraries
+import argparse
+import os
+import sys
+
+import torch
+
+from inference import IMG_SIZE, MODEL_FILES
+
+# Parse Arguments
+parser = argparse.ArgumentParser(description='Model exporter for Canteen Queue Counter')
+parser.add_argument('--weights', type=str, default=MODEL_FILES["torch"], help='Path to crowdhuman_yolov5m.pt')
+parser.add_argument('--output_dir', type=str, default=".", help='Directory to write exported models to')
+parser.add_argument('--formats', type=str, default="torchscript,onnx,onnx_int8", help='Comma separated list of formats to export')
+parser.add_argument('--yolov5_dir', type=str, default=os.path.join(os.path.dirname(__file__), "yolov5"), help='Local yolov5 checkout, used to load the model offline')
+parser.add_argument('--opset', type=int, default=12, help='ONNX opset version')
+args = parser.parse_args()
+
+
+# Load the raw detection model (no AutoShape pre/post processing)
+def load_model(weights):
+    if os.path.isdir(args.yolov5_dir):
+        model = torch.hub.load(args.yolov5_dir, "custom", path=weights, autoshape=False, source="local")
+    else:
+        model = torch.hub.load("ultralytics/yolov5", "custom", path=weights, autoshape=False, skip_validation=True, trust_repo=True)
+    model = getattr(model, "model", model).float().eval()  # Unwrap DetectMultiBackend
+
+    # Make the Detect layer return a single (b, n, 5 + classes) tensor
+    for m in model.modules():
+        if type(m).__name__ == "Detect":
+            m.inplace = False
+            m.export = True
+
+    return model
+
+
+def export_torchscript(model, dummy, path):
+    traced = torch.jit.trace(model, dummy, strict=False)
+    traced.save(path)
+
+
+def export_onnx(model, dummy, path):
+    torch.onnx.export(
+        model, dummy, path,
+        opset_version=args.opset,
+        input_names=["images"],
+        output_names=["output"],
+        dynamic_axes={"images": {0: "batch"}, "output": {0: "batch"}},  # Batched multi-stall inference
+    )
+
+
+# torch.quantization.quantize_dynamic only covers Linear/LSTM layers, which YOLOv5 has none of,
+# so the INT8 variant is a dynamically quantised ONNX model instead (ConvInteger on CPU)
+def export_onnx_int8(onnx_path, path):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    quantize_dynamic(onnx_path, path, weight_type=QuantType.QUInt8)
+
+
+def main():
+    formats = [f.strip() for f in args.formats.split(",") if f.strip()]
+    paths = {name: os.path.join(args.output_dir, file) for name, file in MODEL_FILES.items()}
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    try:
+        model = load_model(args.weights)
+    except Exception as e:
+        print("[FATAL] Failed to load model!")
+        print("Error Log: " + str(e))
+        sys.exit(1)
+
+    dummy = torch.zeros((1, 3, IMG_SIZE, IMG_SIZE))
+    with torch.no_grad():
+        model(dummy)  # Dry run, builds Detect grids
+
+        if "torchscript" in formats:
+            print("[INFO] Exporting TorchScript model to " + paths["torchscript"])
+            export_torchscript(model, dummy, paths["torchscript"])
+
+        if "onnx" in formats or "onnx_int8" in formats:
+            print("[INFO] Exporting ONNX model to " + paths["onnx"])
+            export_onnx(model, dummy, paths["onnx"])
+
+    if "onnx_int8" in formats:
+        print("[INFO] Exporting INT8 ONNX model to " + paths["onnx_int8"])
+        export_onnx_int8(paths["onnx"], paths["onnx_int8"])
+
+    print("[INFO] Done!")
+
+
+# Run
+if __name__ == "__main__":
+    main()
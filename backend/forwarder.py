@@ -0,0 +1,188 @@
+# forwarder.py
+# In charge of forwarding stall updates from the socket server
+# to the Flask webserver, in the background
+
+# Libraries
+import os
+import sys
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../misc"))
+import metrics
+
+# Metrics
+request_seconds = metrics.Histogram("forwarder_request_seconds", "Seconds per request to the Flask server", ("endpoint",))
+request_errors = metrics.Counter("forwarder_errors_total", "Failed requests to the Flask server", ("endpoint", "reason"))
+
+
+# Webserver Forwarder Class
+# put() only stores the update, so the socket server can ACK right away
+# A background thread flushes every flushInterval seconds over a keep-alive connection pool,
+# all pending updates in a single request to the bulk endpoint
+# Updates for the same stall are coalesced into the newest one, and failed updates
+# are retried with exponential backoff unless a newer update replaced them
+# Updates the webserver rejects (e.g. a stall missing from its registry) are dropped and counted,
+# without holding back the other updates of the same flush
+class Forwarder:
+    def __init__(self, url : str, headers : dict, flushInterval=0.5, timeout=5, maxBackoff=30, debug=False):
+        self.url = url
+        self.headers = headers
+        self.flushInterval = flushInterval
+        self.timeout = timeout
+        self.maxBackoff = maxBackoff
+        self.debug = debug
+
+        self.latest = {}  # (canteen, stall name) -> queue time, waiting to be forwarded
+        self.condition = threading.Condition()
+        self.thread = None
+        self.bulk = True  # Turned off if the webserver has no bulk endpoint
+
+        # Keep-alive connection pool
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+        # Stats
+        self.forwarded = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def debug_print(self, msg):
+        if self.debug:
+            print(msg)
+
+    # Start the flushing thread
+    def start(self):
+        if self.thread is not None:
+            return
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Queue an update, replacing any update for the same stall that was not forwarded yet
+    def put(self, canteen : str, stall : str, queueTime):
+        with self.condition:
+            if (canteen, stall) in self.latest:
+                self.coalesced += 1
+
+            self.latest[(canteen, stall)] = queueTime
+            self.condition.notify_all()
+
+    # Forward a single update, returns "ok", "retry" or "rejected"
+    def _post(self, key, queueTime):
+        canteen, stall = key
+        try:
+            with request_seconds.time("update_timing"):
+                r = self.session.post(self.url + "/api/update_timing", params={"canteen": canteen, "stall_name": stall, "queue_time": queueTime}, timeout=self.timeout)
+        except requests.RequestException as e:
+            request_errors.inc("update_timing", "connection")
+            print("[ERROR] Failed to send data to server!")
+            print("Error Log: " + str(e))
+            return "retry"
+
+        if r.status_code != 200:
+            request_errors.inc("update_timing", str(r.status_code))
+            print("[ERROR] Received status code: " + str(r.status_code) + " from server!")
+            print("[ERROR] Response: " + str(r.text))
+            return "retry" if r.status_code >= 500 else "rejected"  # Bad requests will not get better by retrying
+
+        return "ok"
+
+    # Forward all updates in one request, returns (updates to retry, updates rejected)
+    def _postBulk(self, updates):
+        body = {"updates": [{"canteen": canteen, "stall_name": stall, "queue_time": queueTime} for (canteen, stall), queueTime in updates.items()]}
+
+        try:
+            with request_seconds.time("update_timings"):
+                r = self.session.post(self.url + "/api/update_timings", json=body, timeout=self.timeout)
+        except requests.RequestException as e:
+            request_errors.inc("update_timings", "connection")
+            print("[ERROR] Failed to send data to server!")
+            print("Error Log: " + str(e))
+            return updates, {}
+
+        if r.status_code == 404:
+            print("[INFO] Webserver has no bulk endpoint, sending updates one by one")
+            self.bulk = False
+            return self._postEach(updates)
+
+        if r.status_code != 200:
+            request_errors.inc("update_timings", str(r.status_code))
+            print("[ERROR] Received status code: " + str(r.status_code) + " from server!")
+            print("[ERROR] Response: " + str(r.text))
+
+            if r.status_code >= 500:
+                return updates, {}
+
+            # The endpoint applies all updates or none, so send the valid ones again without the invalid ones
+            try:
+                invalid = set(r.json()["invalid"])
+            except (ValueError, KeyError, TypeError):
+                return self._postEach(updates)  # No indices, find the bad updates one by one
+
+            items = list(updates.items())
+            rejected = {key: queueTime for i, (key, queueTime) in enumerate(items) if i in invalid}
+            valid = {key: queueTime for i, (key, queueTime) in enumerate(items) if i not in invalid}
+            if not rejected or not valid:
+                return {}, updates
+
+            failed, moreRejected = self._postBulk(valid)
+            rejected.update(moreRejected)
+            return failed, rejected
+
+        return {}, {}
+
+    def _postEach(self, updates):
+        failed, rejected = {}, {}
+        for key, queueTime in updates.items():
+            result = self._post(key, queueTime)
+            if result == "retry":
+                failed[key] = queueTime
+            elif result == "rejected":
+                rejected[key] = queueTime
+
+        return failed, rejected
+
+    # Flushing thread
+    def _run(self):
+        backoff = self.flushInterval
+
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.latest)
+
+            # Give updates arriving together a chance to coalesce
+            time.sleep(self.flushInterval)
+
+            with self.condition:
+                updates = self.latest
+                self.latest = {}
+
+            failed, rejected = self._postBulk(updates) if self.bulk else self._postEach(updates)
+            self.forwarded += len(updates) - len(failed) - len(rejected)
+            self.debug_print(f"[DEBUG] Forwarded {len(updates) - len(failed) - len(rejected)} updates")
+
+            if rejected:
+                self.rejected += len(rejected)
+                print("[ERROR] Webserver rejected updates for: " + ", ".join(f"{canteen}/{stall}" for canteen, stall in rejected))
+
+            if not failed:
+                backoff = self.flushInterval
+                continue
+
+            # Retry failed updates, unless a newer one came in meanwhile
+            self.failed += len(failed)
+            with self.condition:
+                for key, queueTime in failed.items():
+                    self.latest.setdefault(key, queueTime)
+
+            print(f"Retrying in {backoff:.1f} seconds...")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, self.maxBackoff)
@@ -0,0 +1,255 @@
+# inference.py
+# In charge of running the crowdhuman YOLOv5 model,
+# on one of several CPU inference engines
+
+# Libraries
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import tracing
+
+IMG_SIZE = 640        # Model input size
+CONF_THRESHOLD = 0.25  # Same defaults as the torch.hub AutoShape model
+IOU_THRESHOLD = 0.45
+MAX_DET = 1000
+
+BACKENDS = ["torch", "torchscript", "onnx", "onnx_int8"]
+
+# Default model file for every backend, as written by export_model.py
+MODEL_FILES = {
+    "torch": "crowdhuman_yolov5m.pt",
+    "torchscript": "crowdhuman_yolov5m.torchscript",
+    "onnx": "crowdhuman_yolov5m.onnx",
+    "onnx_int8": "crowdhuman_yolov5m.int8.onnx",
+}
+
+
+# Resize and pad image to a square of size x size, keeping aspect ratio
+# Returns padded image, scale gain and (left, top) padding
+def letterbox(image, size=IMG_SIZE):
+    h, w = image.shape[:2]
+    gain = min(size / h, size / w)
+    newW, newH = int(round(w * gain)), int(round(h * gain))
+
+    if (newW, newH) != (w, h):
+        image = cv2.resize(image, (newW, newH), interpolation=cv2.INTER_LINEAR)
+
+    left, top = (size - newW) // 2, (size - newH) // 2
+    image = cv2.copyMakeBorder(image, top, size - newH - top, left, size - newW - left, cv2.BORDER_CONSTANT, value=(114, 114, 114))
+    return image, gain, (left, top)
+
+
+# Non maximum suppression on raw YOLOv5 output for one image
+# pred is (n, 5 + classes), xywh + objectness + class scores
+# Returns (m, 6) array of xyxy, confidence, class
+def non_max_suppression(pred, confThreshold=CONF_THRESHOLD, iouThreshold=IOU_THRESHOLD):
+    pred = pred[pred[:, 4] > confThreshold]
+    if not len(pred):
+        return np.zeros((0, 6), dtype=np.float32)
+
+    scores = pred[:, 5:] * pred[:, 4:5]
+    classes = scores.argmax(axis=1)
+    conf = scores[np.arange(len(scores)), classes]
+
+    mask = conf > confThreshold
+    pred, classes, conf = pred[mask], classes[mask], conf[mask]
+
+    boxes = np.empty((len(pred), 4), dtype=np.float32)
+    boxes[:, :2] = pred[:, :2] - pred[:, 2:4] / 2
+    boxes[:, 2:] = pred[:, :2] + pred[:, 2:4] / 2
+
+    # Offset boxes by class so that NMS is done per class
+    offset = classes[:, None].astype(np.float32) * 4096
+    rects = np.concatenate([boxes[:, :2] + offset, pred[:, 2:4]], axis=1)
+    keep = cv2.dnn.NMSBoxes(rects.tolist(), conf.tolist(), confThreshold, iouThreshold, top_k=MAX_DET)
+    keep = np.array(keep, dtype=np.int64).reshape(-1)
+
+    return np.concatenate([boxes[keep], conf[keep, None], classes[keep, None].astype(np.float32)], axis=1)
+
+
+# Inference Backend Class
+# Base for engines that run the raw exported model
+# infer() takes a list of BGR images and returns one (n, 6) array per image,
+# holding normalised xyxy boxes, confidence and class (like results.xyxyn)
+class Backend:
+    name = None
+
+    def __init__(self, modelPath : str):
+        self.modelPath = modelPath
+
+    # Letterbox and stack images into a (b, 3, IMG_SIZE, IMG_SIZE) float32 batch
+    def preprocess(self, images):
+        batch = np.empty((len(images), 3, IMG_SIZE, IMG_SIZE), dtype=np.float32)
+        meta = []
+
+        for i, image in enumerate(images):
+            padded, gain, pad = letterbox(image)
+            batch[i] = padded[:, :, ::-1].transpose(2, 0, 1)  # BGR HWC to RGB CHW
+            meta.append((image.shape[:2], gain, pad))
+
+        batch /= 255.0
+        return batch, meta
+
+    # Run the model on a batch, returns raw (b, n, 5 + classes) predictions
+    def forward(self, batch):
+        raise NotImplementedError
+
+    # NMS and scale boxes back to normalised coordinates of the original images
+    def postprocess(self, pred, meta):
+        detections = []
+
+        for p, ((h, w), gain, (left, top)) in zip(pred, meta):
+            det = non_max_suppression(p)
+            det[:, [0, 2]] = ((det[:, [0, 2]] - left) / gain).clip(0, w) / w
+            det[:, [1, 3]] = ((det[:, [1, 3]] - top) / gain).clip(0, h) / h
+            detections.append(det)
+
+        return detections
+
+    def infer(self, images):
+        with tracing.span("preprocess", "inference"):
+            batch, meta = self.preprocess(images)
+        with tracing.span("forward", "inference"):
+            pred = self.forward(batch)
+        with tracing.span("nms", "inference"):
+            return self.postprocess(pred, meta)
+
+
+# Eager PyTorch, through the torch.hub AutoShape model
+# Loaded from a local yolov5 checkout when yolov5Dir exists, so no GitHub access is needed
+class TorchBackend(Backend):
+    name = "torch"
+
+    def __init__(self, modelPath : str, yolov5Dir=None):
+        super().__init__(modelPath)
+
+        import torch
+        if yolov5Dir is not None and os.path.isdir(yolov5Dir):
+            self.model = torch.hub.load(yolov5Dir, "custom", path=modelPath, source="local")
+        else:
+            # Falls back to the hub cache, without re-validating it against GitHub
+            self.model = torch.hub.load("ultralytics/yolov5", "custom", path=modelPath, skip_validation=True, trust_repo=True)
+
+    # AutoShape does its own preprocessing and NMS, traced as one span
+    # It takes numpy images as RGB, so frames are flipped like preprocess() does for the other backends
+    def infer(self, images):
+        with tracing.span("forward", "inference"):
+            results = self.model([image[..., ::-1] for image in images])
+        return [detections.numpy() for detections in results.xyxyn]
+
+
+# TorchScript model exported by export_model.py
+class TorchScriptBackend(Backend):
+    name = "torchscript"
+
+    def __init__(self, modelPath : str):
+        super().__init__(modelPath)
+
+        import torch
+        self.torch = torch
+        self.model = torch.jit.load(modelPath, map_location="cpu").eval()
+
+    def forward(self, batch):
+        with self.torch.inference_mode():
+            pred = self.model(self.torch.from_numpy(batch))
+
+        if isinstance(pred, (list, tuple)):
+            pred = pred[0]
+        return pred.numpy()
+
+
+# ONNX Runtime, for both the float and the INT8 quantised model exported by export_model.py
+class OnnxBackend(Backend):
+    name = "onnx"
+
+    def __init__(self, modelPath : str):
+        super().__init__(modelPath)
+
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.session = onnxruntime.InferenceSession(modelPath, options, providers=["CPUExecutionProvider"])
+        self.inputName = self.session.get_inputs()[0].name
+
+    def forward(self, batch):
+        return self.session.run(None, {self.inputName: batch})[0]
+
+
+class OnnxInt8Backend(OnnxBackend):
+    name = "onnx_int8"
+
+
+# Create an inference backend by name
+def load_backend(name : str, modelPath=None, yolov5Dir=None):
+    backends = {
+        "torch": TorchBackend,
+        "torchscript": TorchScriptBackend,
+        "onnx": OnnxBackend,
+        "onnx_int8": OnnxInt8Backend,
+    }
+
+    if name not in backends:
+        raise ValueError(f"Unknown inference backend: {name}")
+
+    if name == "torch":
+        return TorchBackend(modelPath or MODEL_FILES[name], yolov5Dir=yolov5Dir)
+
+    return backends[name](modelPath or MODEL_FILES[name])
+
+
+# Model Loader Class
+# Loads the backend once in a background thread and runs a warm-up inference,
+# so the rest of the client can start while the model loads
+class ModelLoader:
+    def __init__(self, name : str, modelPath=None, yolov5Dir=None, warmupShape=(IMG_SIZE, IMG_SIZE, 3)):
+        self.name = name
+        self.modelPath = modelPath
+        self.yolov5Dir = yolov5Dir
+        self.warmupShape = warmupShape
+
+        self.backend = None
+        self.error = None
+        self.ready = threading.Event()
+        self.thread = None
+
+    # Start loading the model in the background
+    def start(self):
+        if self.thread is not None:
+            return
+
+        self.thread = threading.Thread(target=self._load)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _load(self):
+        start_time = time.time()
+
+        try:
+            backend = load_backend(self.name, self.modelPath, yolov5Dir=self.yolov5Dir)
+
+            # Warm-up inference, so the first real frame is not slowed by lazy initialisation
+            backend.infer([np.zeros(self.warmupShape, dtype=np.uint8)])
+
+            self.backend = backend
+            print(f"[INFO] Model ready ({self.name}) in {time.time() - start_time:.1f}s")
+        except Exception as e:
+            self.error = e
+
+        self.ready.set()
+
+    # Wait for the model to finish loading, returns False if loading failed
+    def wait(self, timeout=None):
+        self.ready.wait(timeout)
+        return self.backend is not None
+
+    # Run inference, waiting for the model to be ready
+    def infer(self, images):
+        if not self.wait():
+            raise RuntimeError(f"Model failed to load: {self.error}")
+
+        return self.backend.infer(images)
@@ -0,0 +1,56 @@
+# motion.py
+# In charge of cheap change detection on the cut stall image,
+# so inference can be skipped when the scene has not moved
+
+# Libraries
+import time
+
+import cv2
+import numpy as np
+
+
+# Motion Gate Class
+# Compares a downscaled, blurred greyscale copy of the cut image against the one
+# from the last inference, and only asks for a new inference when enough pixels changed
+# or the last count is older than maxAge seconds
+class MotionGate:
+    def __init__(self, threshold : float, maxAge : float, size=(64, 64), pixelThreshold=25):
+        self.threshold = threshold            # Fraction of changed pixels needed to run inference
+        self.maxAge = maxAge                  # Seconds before inference is forced
+        self.size = size
+        self.pixelThreshold = pixelThreshold  # Difference for a single pixel to count as changed
+
+        self.reference = None
+        self.referenceTime = 0
+
+        # Stats, for monitoring
+        self.checks = 0
+        self.skips = 0
+
+    # Downscale, greyscale and blur image
+    def _small(self, image):
+        small = cv2.resize(image, self.size, interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+        return cv2.GaussianBlur(small, (3, 3), 0)
+
+    # Check if image needs inference, updates the reference image if it does
+    def check(self, image):
+        self.checks += 1
+        small = self._small(image)
+        now = time.monotonic()
+
+        if self.reference is not None and now - self.referenceTime < self.maxAge:
+            changed = np.count_nonzero(cv2.absdiff(small, self.reference) > self.pixelThreshold) / small.size
+            if changed < self.threshold:
+                self.skips += 1
+                return False
+
+        self.reference = small
+        self.referenceTime = now
+        return True
+
+    # Fraction of checks that skipped inference
+    def skipRate(self):
+        return self.skips / self.checks if self.checks else 0.0
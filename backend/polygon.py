@@ -0,0 +1,52 @@
+# polygon.py
+# In charge of assigning detections in the full camera frame
+# to the stall polygons (imageCutPositions) they fall in
+
+# Libraries
+import numpy as np
+
+HEAD_CLASS = 1
+PERSON_CLASS = 0
+
+
+# Vectorised ray casting point in polygon test
+# points is (n, 2), polygons is (s, k, 2), returns (n, s) bool array
+def points_in_polygons(points, polygons):
+    x = points[:, 0][:, None, None]
+    y = points[:, 1][:, None, None]
+
+    x1, y1 = polygons[None, :, :, 0], polygons[None, :, :, 1]
+    x2, y2 = np.roll(x1, -1, axis=2), np.roll(y1, -1, axis=2)
+
+    # Edges crossing the horizontal ray going right from the point
+    with np.errstate(divide="ignore", invalid="ignore"):
+        crosses = ((y1 > y) != (y2 > y)) & (x < (x2 - x1) * (y - y1) / (y2 - y1) + x1)
+
+    return crosses.sum(axis=2) % 2 == 1
+
+
+# Get the point used to place each detection, in pixels
+# head: centre of head boxes, foot: bottom centre of person boxes
+def anchor_points(detections, width : int, height : int, anchor="head"):
+    if anchor == "foot":
+        x = (detections[:, 0] + detections[:, 2]) / 2
+        y = detections[:, 3]
+    else:
+        x = (detections[:, 0] + detections[:, 2]) / 2
+        y = (detections[:, 1] + detections[:, 3]) / 2
+
+    return np.stack([x * width, y * height], axis=1)
+
+
+# Count detections of the anchor's class above confThreshold in every polygon
+# detections is (n, 6) normalised xyxy, confidence, class of the full frame
+# A detection inside several overlapping polygons counts for the first one
+# Returns (s,) array of counts
+def count_in_polygons(detections, polygons, width : int, height : int, confThreshold : float, anchor="head"):
+    cls = PERSON_CLASS if anchor == "foot" else HEAD_CLASS
+    detections = detections[(detections[:, 5] == cls) & (detections[:, 4] >= confThreshold)]
+
+    inside = points_in_polygons(anchor_points(detections, width, height, anchor), polygons)
+    assigned = inside.any(axis=1)
+
+    return np.bincount(inside[assigned].argmax(axis=1), minlength=len(polygons))
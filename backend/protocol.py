@@ -0,0 +1,146 @@
+# protocol.py
+# In charge of encoding and decoding the binary wire protocol
+# between the Pi clients (client.py) and the socket server (server.py)
+#
+# Every frame is a fixed 8 byte header followed by the payload:
+#   magic (2s) | version (B) | type (B) | payload length (I)
+#
+# A connection starts with a challenge-response handshake, so the password never goes over the wire:
+#   client HELLO (client nonce) -> server CHALLENGE (server nonce) -> client AUTH (HMAC) -> server WELCOME
+# Both sides then derive a session key, and every REPORT carries a truncated HMAC under it
+# A REPORT is ACKed with its sequence number, or rejected with an ERROR carrying its sequence number and the reason
+
+# Libraries
+import hashlib
+import hmac
+import math
+import os
+import struct
+
+MAGIC = b"CQ"
+VERSION = 1
+
+HEADER = struct.Struct("!2sBBI")
+REPORT = struct.Struct("!HHHII")   # Stall ID (registry), people count, wait seconds, timestamp, sequence number
+ACK = struct.Struct("!I")          # Sequence number
+
+NONCE_SIZE = 16
+MAC_SIZE = 32
+TAG_SIZE = 8                       # Truncated HMAC on every report
+MAX_PAYLOAD = 1024
+
+# Frame types
+HELLO = 1
+CHALLENGE = 2
+AUTH = 3
+WELCOME = 4
+REPORT_FRAME = 5
+ACK_FRAME = 6
+ERROR = 7
+
+# Stall IDs come from the stall registry (misc/stalls.json)
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# Format wait time in seconds the way it is displayed, in mins
+def format_wait(secs):
+    approx_mins = secs / 60
+
+    if approx_mins < 1.0:
+        return 0.9
+    else:
+        return "~" + str(math.ceil(approx_mins))
+
+
+def new_nonce():
+    return os.urandom(NONCE_SIZE)
+
+
+def encode_frame(frameType : int, payload=b""):
+    return HEADER.pack(MAGIC, VERSION, frameType, len(payload)) + payload
+
+
+# Proof that the client knows the password, for this pair of nonces
+def auth_mac(password : str, clientNonce : bytes, serverNonce : bytes):
+    return hmac.new(password.encode(), b"auth" + clientNonce + serverNonce, hashlib.sha256).digest()
+
+
+def session_key(password : str, clientNonce : bytes, serverNonce : bytes):
+    return hmac.new(password.encode(), b"session" + clientNonce + serverNonce, hashlib.sha256).digest()
+
+
+def encode_report(key : bytes, stallId : int, count : int, waitSecs : int, timestamp : int, seq : int):
+    payload = REPORT.pack(stallId, min(count, 0xFFFF), min(int(waitSecs), 0xFFFF), timestamp & 0xFFFFFFFF, seq & 0xFFFFFFFF)
+    tag = hmac.new(key, payload, hashlib.sha256).digest()[:TAG_SIZE]
+    return encode_frame(REPORT_FRAME, payload + tag)
+
+
+# Returns (stall ID, count, wait seconds, timestamp, sequence number), raises ProtocolError on a bad tag
+def decode_report(key : bytes, payload : bytes):
+    if len(payload) != REPORT.size + TAG_SIZE:
+        raise ProtocolError("Bad report size")
+
+    report, tag = payload[:REPORT.size], payload[REPORT.size:]
+    if not hmac.compare_digest(tag, hmac.new(key, report, hashlib.sha256).digest()[:TAG_SIZE]):
+        raise ProtocolError("Bad report HMAC")
+
+    return REPORT.unpack(report)
+
+
+# Seconds a 32 bit report timestamp is ahead of now (negative if behind), across the wrap around
+def timestamp_skew(timestamp : int, now : float):
+    return (timestamp - int(now) + 0x80000000) % 0x100000000 - 0x80000000
+
+
+def encode_ack(seq : int):
+    return encode_frame(ACK_FRAME, ACK.pack(seq & 0xFFFFFFFF))
+
+
+def decode_ack(payload : bytes):
+    if len(payload) != ACK.size:
+        raise ProtocolError("Bad ACK size")
+
+    return ACK.unpack(payload)[0]
+
+
+# Reject a report, the reason is logged by the client, which does not send the report again
+def encode_error(seq : int, reason : str):
+    return encode_frame(ERROR, ACK.pack(seq & 0xFFFFFFFF) + reason.encode()[:MAX_PAYLOAD - ACK.size])
+
+
+# Returns (sequence number, reason), sequence number None for an ERROR without one, like a failed handshake
+def decode_error(payload : bytes):
+    if len(payload) < ACK.size:
+        return None, payload.decode(errors="replace")
+
+    return ACK.unpack_from(payload)[0], payload[ACK.size:].decode(errors="replace")
+
+
+# Frame Decoder Class
+# Buffers bytes as they are received and returns complete (type, payload) frames,
+# so partial and coalesced reads are handled the same way on both ends
+class FrameDecoder:
+    def __init__(self):
+        self.buffer = b""
+
+    def feed(self, data : bytes):
+        self.buffer += data
+        frames = []
+
+        while len(self.buffer) >= HEADER.size:
+            magic, version, frameType, length = HEADER.unpack_from(self.buffer)
+
+            if magic != MAGIC or version != VERSION:
+                raise ProtocolError("Bad frame header")
+            if length > MAX_PAYLOAD:
+                raise ProtocolError("Frame too large")
+            if len(self.buffer) < HEADER.size + length:
+                break
+
+            frames.append((frameType, self.buffer[HEADER.size:HEADER.size + length]))
+            self.buffer = self.buffer[HEADER.size + length:]
+
+        return frames
@@ -0,0 +1,95 @@
+# scheduler.py
+# In charge of deciding when every queue should be sampled next,
+# based on how busy it is, the time of day and the Pi's CPU budget
+
+# Libraries
+import collections
+import threading
+import time
+
+
+# Parse "HH:MM-HH:MM,HH:MM-HH:MM" into a list of (start, end) hours
+def parse_hours(hours : str):
+    windows = []
+    for window in hours.split(","):
+        if not window.strip():
+            continue
+
+        start, end = window.strip().split("-")
+        windows.append(tuple(int(h) + int(m) / 60 for h, m in (t.split(":") for t in (start, end))))
+
+    return windows
+
+
+# Adaptive Sampling Scheduler Class
+# Samples busy / changing queues every few seconds and empty ones every few minutes
+# Also caps the number of inferences per minute across all queues (token bucket),
+# and keeps the share of CPU time spent on inference under cpuBudget
+class Scheduler:
+    def __init__(self, minInterval : float, maxInterval : float, maxPerMinute : float, cpuBudget : float, peakHours=(), peakFactor=0.5):
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.cpuBudget = cpuBudget      # Fraction of a core that inference may use
+        self.peakHours = peakHours      # List of (start, end) hours
+        self.peakFactor = peakFactor    # Interval multiplier during peak hours
+
+        self.history = collections.defaultdict(lambda: collections.deque(maxlen=10))  # Recent counts per queue
+        self.inferenceTime = {}  # Last inference duration per queue, seconds
+
+        # Token bucket, shared by all queues
+        self.maxPerMinute = maxPerMinute
+        self.tokens = maxPerMinute
+        self.lastRefill = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Record the result of an inference for a queue
+    def record(self, name : str, count : int, inferenceSeconds : float):
+        self.history[name].append(count)
+        self.inferenceTime[name] = inferenceSeconds
+
+    # Mean absolute change between consecutive counts
+    def volatility(self, name : str):
+        counts = self.history[name]
+        if len(counts) < 2:
+            return 0.0
+
+        return sum(abs(b - a) for a, b in zip(counts, list(counts)[1:])) / (len(counts) - 1)
+
+    def isPeak(self):
+        now = time.localtime()
+        hour = now.tm_hour + now.tm_min / 60
+        return any(start <= hour < end for start, end in self.peakHours)
+
+    # Seconds between two samples of a queue
+    def nextInterval(self, name : str):
+        counts = self.history[name]
+        if not counts:
+            return self.minInterval
+
+        # More people and more change means sampling more often
+        activity = self.volatility(name) + 0.25 * counts[-1]
+        interval = self.maxInterval / (1 + 4 * activity)
+
+        if self.isPeak():
+            interval *= self.peakFactor
+
+        # Stay within the CPU budget, shared equally between all queues
+        cpuInterval = self.inferenceTime.get(name, 0) * len(self.history) / self.cpuBudget
+
+        return min(max(interval, cpuInterval, self.minInterval), self.maxInterval)
+
+    # Take an inference token, waiting until one is available
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.maxPerMinute, self.tokens + (now - self.lastRefill) * self.maxPerMinute / 60)
+                self.lastRefill = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) * 60 / self.maxPerMinute
+
+            time.sleep(wait)
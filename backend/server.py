@@ -5,14 +5,22 @@
 # Libraries
 import tkinter as tk
 import threading
-import socket
+import asyncio
+import hmac
+import queue
+import heapq
 
 import argparse
 import os
 import time
 import sys
 
-import requests
+import protocol
+from forwarder import Forwarder
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../misc"))
+import metrics
+from registry import RegistryError, load_registry
 
 # Parse Arguments
 parser = argparse.ArgumentParser(description='Socket Server for Canteen Queue Counter')
@@ -20,6 +28,15 @@ parser.add_argument('--debug', default=False, action="store_true", help='Turns o
 parser.add_argument('--url', type=str, default="http://localhost", help='URL of Flask Server')
 parser.add_argument('--ip', type=str, default="0.0.0.0", help='IP Address of Socket Server')
 parser.add_argument('--port', type=int, default=6942, help='Port of Socket Server')
+parser.add_argument('--max_connections', type=int, default=4096, help='Maximum number of client connections served at once')
+parser.add_argument('--read_timeout', type=float, default=600, help='Seconds a client connection may stay silent before it is closed')
+parser.add_argument('--no_gui', default=False, action="store_true", help='Runs without the Tk GUI, e.g. headless or under load tests')
+parser.add_argument('--gui_refresh', type=int, default=250, help='Milliseconds between GUI refreshes')
+parser.add_argument('--registry', type=str, default=None, help='Stall registry file, misc/stalls.json by default')
+parser.add_argument('--metrics_port', type=int, default=9102, help='Port to serve Prometheus metrics on, 0 to turn off')
+parser.add_argument('--metrics_host', type=str, default="127.0.0.1", help='Address to serve Prometheus metrics on, 0.0.0.0 for remote scraping')
+parser.add_argument('--max_clock_skew', type=float, default=300, help='Seconds the clock of a binary client may drift within a session, from its offset at the first report, 0 to turn off')
+parser.add_argument('--flush_interval', type=float, default=0.5, help='Seconds between forwarding updates to the Flask server')
 args = parser.parse_args()
 
 # Variables
@@ -48,12 +65,40 @@ except KeyError:
     print("[FATAL] Missing credentials in credentials.txt")
     sys.exit(1)
 
-stall_name = ["Drinks", "Snacks", "Malay 1", "Malay 2", "Western", "Chicken Rice", "Oriental Taste", "CLOSED"]
-displayed = {}  # Format: [<Tkinter Label Class>, <Last Updated Time (int)>]
-max_clients = 8
+# Stalls of every canteen, from the stall registry
+# State below is keyed by stall ID, the same name may be used in several canteens
+try:
+    registry = load_registry(args.registry)
+except RegistryError as e:
+    print("[FATAL] " + str(e))
+    sys.exit(1)
+
+displayed = {}  # Format: [<Tkinter Label Class>, <Displayed Text (str)>], only touched by the Tk thread
+last_updated = {stall_id: time.monotonic() for stall_id in registry.byId}  # Monotonic time of last update
+gui_updates = queue.Queue()  # (stall ID, waiting time) posted by any thread, applied by the Tk thread
+max_clients = 1024  # Listen backlog
 
 last_update_threshold = 60
 
+# Expiry scheduler state, min-heap of (time stall goes stale, stall)
+# Stalls are stall IDs, a stall has at most one entry, so the heap never grows past the number of stalls
+expiry_heap = []
+expiry_scheduled = set()
+expiry_condition = threading.Condition()
+
+# Forwards updates to Flask server in the background, started in main()
+forwarder = Forwarder(url, {auth_key: auth_token}, flushInterval=args.flush_interval, debug=debug)
+
+# Metrics, served on --metrics_port from main()
+connections = metrics.Counter("server_connections_total", "Client connections accepted, per protocol", ("protocol",))
+open_connections = metrics.Gauge("server_open_connections", "Client connections open now")
+reports_received = metrics.Counter("server_reports_total", "Reports received, per result", ("result",))
+ingest_seconds = metrics.Histogram("server_ingest_seconds", "Seconds from receiving reports to queueing their updates and ACKs")
+metrics.Counter("forwarder_updates_total", "Updates forwarded to the Flask server", function=lambda: forwarder.forwarded)
+metrics.Counter("forwarder_coalesced_total", "Updates replaced by a newer one before being forwarded", function=lambda: forwarder.coalesced)
+metrics.Counter("forwarder_retries_total", "Updates that failed and were queued again", function=lambda: forwarder.failed)
+metrics.Counter("forwarder_rejected_total", "Updates rejected by the Flask server, e.g. for stalls it does not know", function=lambda: forwarder.rejected)
+
 # Debug print
 def debug_print(msg):
     if debug:
@@ -66,98 +111,275 @@ def init_GUI():
     widgetWrapper = tk.Text(root, wrap="char", borderwidth=0, highlightthickness=0, state="disabled", cursor="arrow") 
     widgetWrapper.pack(fill="both", expand=True)
 
-    def additem(i):
-        item = tk.Label(bd = 5, relief="solid", text=f"{stall_name[i]}:\n\n               ???               \nmins", font=('Arial', 25), bg="white") #Create the actual widgets
-        displayed[stall_name[i]] = [item, 0]
+    def additem(stall):
+        text = f"{stall.textName}:\n\n               ???               \nmins"
+        item = tk.Label(bd = 5, relief="solid", text=text, font=('Arial', 25), bg="white") #Create the actual widgets
+        displayed[stall.stallId] = [item, text]
         widgetWrapper.window_create("end", window=item)
 
-    for i in range(8):
-        additem(i)
+    for stalls in registry.canteens.values():
+        for stall in stalls:
+            additem(stall)
+
+    # Apply GUI updates from the Tk thread, at most once every gui_refresh ms
+    def refresh():
+        apply_gui_updates()
+        root.after(args.gui_refresh, refresh)
 
+    root.after(args.gui_refresh, refresh)
     root.mainloop()
 
-# Update last updated time
-def last_update_updater():
+# Apply queued GUI updates, only the latest one per stall and only if it changes the label
+# Must be called from the Tk thread
+def apply_gui_updates():
+    latest = {}
     while True:
-        time.sleep(1)
-        # Key is stall name, value is [<Tkinter Label Class>, <Last Updated Time (int)>]
-        for key, value in displayed.items():
-            value[1] += 1
-
-            if value[1] >= last_update_threshold:
-                value[0].config(text=f"{key}:\n\n               ???               \nmins\n")
-
-# On Recv Data function
-def on_recv_data(c, addr):
-    # Get data
-    data = c.recv(1024).decode()
+        try:
+            stall_id, waiting_time = gui_updates.get_nowait()
+        except queue.Empty:
+            break
+        latest[stall_id] = waiting_time
+
+    for stall_id, waiting_time in latest.items():
+        text = f"{registry.byId[stall_id].textName}:\n\n               {waiting_time}               \nmins\n"
+        if stall_id in displayed and displayed[stall_id][1] != text:
+            displayed[stall_id][0].config(text=text)
+            displayed[stall_id][1] = text
+
+# Check if a stall has not been updated for too long
+def is_stale(stall_id):
+    return time.monotonic() - last_updated[stall_id] >= last_update_threshold
+
+# Record an update of a stall, scheduling it to go stale
+def mark_updated(stall_id):
+    with expiry_condition:
+        now = time.monotonic()
+        last_updated[stall_id] = now
+
+        if stall_id not in expiry_scheduled:
+            expiry_scheduled.add(stall_id)
+            heapq.heappush(expiry_heap, (now + last_update_threshold, stall_id))
+            expiry_condition.notify()
+
+# Expiry scheduler, only wakes up when the next stall goes stale
+def expiry_scheduler():
+    with expiry_condition:
+        while True:
+            if not expiry_heap:
+                expiry_condition.wait()
+                continue
+
+            now = time.monotonic()
+            deadline, stall_id = expiry_heap[0]
+            if deadline > now:
+                expiry_condition.wait(deadline - now)
+                continue
+
+            heapq.heappop(expiry_heap)
+
+            # Updated since it was scheduled, reschedule from the last update
+            if not is_stale(stall_id):
+                heapq.heappush(expiry_heap, (last_updated[stall_id] + last_update_threshold, stall_id))
+                continue
+
+            expiry_scheduled.discard(stall_id)
+            if not args.no_gui:
+                gui_updates.put((stall_id, "???"))
+
+# On Report function
+# Handles a single "password|stall|time" report, returns False if it is invalid
+def on_report(data):
     data = data.split("|")
 
-    # Check if data is valid
-    if (data[0] != password or len(data) != 3 or data[1] not in stall_name):
+    # Check if data is valid, stall is "canteen/stall" outside the default canteen
+    stall = registry.lookup(data[1]) if len(data) == 3 else None
+    if (data[0] != password or stall is None):
+        reports_received.inc("invalid")
         print("[ERROR] Invalid data received!")
-        c.send(b"ACK")
-        c.close()
-        return
+        return False
 
-    # Update GUI from data
-    stall = data[1]
-    waiting_time = data[2]
+    reports_received.inc("ok")
+    update_stall(stall, data[2])
+    return True
 
-    displayed[stall][0].config(text=f"{stall}:\n\n               {waiting_time}               \nmins\n")
+# Update GUI and Flask server with the waiting time of a registry stall
+def update_stall(stall, waiting_time):
+    # Reset Last Updated Time, before the GUI update so a racing expiry cannot overwrite it
+    mark_updated(stall.stallId)
 
-    # Update Flask server
-    authentication = {auth_key: auth_token}
+    # Update GUI from data, applied by the Tk thread
+    if not args.no_gui:
+        gui_updates.put((stall.stallId, waiting_time))
 
-    try:
-        r = requests.post(url + f"/api/update_timing?stall_name={stall}&queue_time={waiting_time}", headers=authentication)
-        if r.status_code != 200:
-            print("[ERROR] Received status code: " + str(r.status_code) + " from server!")
-            print("[ERROR] Response: " + str(r.text))
-    except Exception as e:
-        print("[ERROR] Failed to send data to server!")
-        print("Error Log: " + str(e))
+    # Update Flask server, in the background
+    forwarder.put(stall.canteen, stall.name, waiting_time)
 
-    # Reset Last Updated Time
-    displayed[stall][1] = 0
+def on_reports(reports):
+    with ingest_seconds.time():
+        for report in reports:
+            on_report(report.decode(errors="replace"))  # Not UTF-8 is invalid like any other bad report
 
-    # Send ACK
-    c.send(b"ACK")
-    c.close()
+def update_stalls(updates):
+    for stall, waiting_time in updates:
+        update_stall(stall, waiting_time)
 
-    return
+# On Recv Binary function
+# Serves a client speaking the binary protocol (see protocol.py), starting with the handshake
+async def on_recv_binary(reader, writer, buffer):
+    decoder = protocol.FrameDecoder()
+    client_nonce = server_nonce = key = None
+    last_seq = 0  # Sequence numbers must go up within a session, so reports cannot be replayed
+    clock_offset = None  # Client clock minus server clock at the first report, Pis without a clock source may be far off
 
-# Main Server function
-def main():
-    # Init GUI thread
-    init_GUI_thread = threading.Thread(target=init_GUI)
-    init_GUI_thread.start()
+    while True:
+        updates = []
+        acks = b""
+        start_time = time.perf_counter()
+
+        for frame_type, payload in decoder.feed(buffer):
+            # Handshake, the password itself is never sent
+            if key is None:
+                if frame_type == protocol.HELLO and client_nonce is None and len(payload) == protocol.NONCE_SIZE:
+                    client_nonce, server_nonce = payload, protocol.new_nonce()
+                    writer.write(protocol.encode_frame(protocol.CHALLENGE, server_nonce))
+                elif frame_type == protocol.AUTH and client_nonce is not None and hmac.compare_digest(payload, protocol.auth_mac(password, client_nonce, server_nonce)):
+                    key = protocol.session_key(password, client_nonce, server_nonce)
+                    writer.write(protocol.encode_frame(protocol.WELCOME))
+                else:
+                    print("[ERROR] Client failed authentication!")
+                    writer.write(protocol.encode_frame(protocol.ERROR))
+                    await writer.drain()
+                    return
+
+            elif frame_type == protocol.REPORT_FRAME:
+                try:
+                    stall_id, people_count, wait_secs, timestamp, seq = protocol.decode_report(key, payload)
+                except protocol.ProtocolError as e:
+                    reports_received.inc("invalid")
+                    print("[ERROR] Invalid data received! " + str(e))
+                    continue
+
+                # Replayed or delayed reports are rejected with an ERROR, so the client does not send them again
+                if seq <= last_seq:
+                    reports_received.inc("replayed")
+                    reason = f"Sequence number {seq} after {last_seq}"
+                    print("[ERROR] Invalid data received! " + reason)
+                    acks += protocol.encode_error(seq, reason)
+                    continue
+
+                skew = protocol.timestamp_skew(timestamp, time.time())
+                if clock_offset is None:
+                    clock_offset = skew
+                elif args.max_clock_skew and abs(skew - clock_offset) > args.max_clock_skew:
+                    reports_received.inc("stale")
+                    reason = f"Timestamp {skew - clock_offset:+d} seconds off from the start of the session"
+                    print("[ERROR] Invalid data received! " + reason)
+                    acks += protocol.encode_error(seq, reason)
+                    continue
+
+                last_seq = seq
+                if stall_id in registry.byId:
+                    reports_received.inc("ok")
+                    updates.append((registry.byId[stall_id], protocol.format_wait(wait_secs)))
+                else:
+                    reports_received.inc("unknown_stall")
+                    print("[ERROR] Invalid data received! Unknown stall ID " + str(stall_id))
+
+                acks += protocol.encode_ack(seq)
+
+        if updates:
+            update_stalls(updates)
+
+        if acks:
+            writer.write(acks)
+            ingest_seconds.observe(time.perf_counter() - start_time)
+        await writer.drain()
+
+        buffer = await asyncio.wait_for(reader.read(4096), args.read_timeout)
+        if not buffer:
+            return
 
-    time.sleep(1)
+# On Recv Data function
+# Coroutine serving a single client connection
+async def on_recv_data(reader, writer, slots):
+    addr = writer.get_extra_info("peername")
 
-    # Start last updated time updater thread
-    last_update_updater_thread = threading.Thread(target=last_update_updater)
-    last_update_updater_thread.start()
+    async with slots:
+        debug_print("[DEBUG] Accepted connection from " + str(addr))
+        open_connections.inc()
+
+        try:
+            buffer = await asyncio.wait_for(reader.read(1024), args.read_timeout)
+
+            # Binary protocol clients
+            if buffer.startswith(protocol.MAGIC):
+                connections.inc("binary")
+                await on_recv_binary(reader, writer, buffer)
+                return
+
+            # Text clients send a single report, then wait for the ACK
+            if buffer:
+                connections.inc("text")
+                on_reports([buffer.rstrip(b"\r\n")])
+                writer.write(b"ACK")
+                await writer.drain()
+        except asyncio.TimeoutError:
+            debug_print("[DEBUG] Connection timed out: " + str(addr))
+        except protocol.ProtocolError as e:
+            print("[ERROR] Invalid frame from " + str(addr) + ": " + str(e))
+        except (ConnectionError, OSError) as e:
+            debug_print("[DEBUG] Connection error from " + str(addr) + ": " + str(e))
+        finally:
+            debug_print("[DEBUG] Connection closed: " + str(addr))
+            open_connections.dec()
+            writer.close()
+
+# Ingest server, serving every client connection on one event loop
+async def serve():
+    slots = asyncio.Semaphore(args.max_connections)  # Bounded concurrency
 
-    # Create socket
     try:
         print("[INFO] Creating socket...")
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.bind((server_ip, server_port))
-        s.listen(max_clients)
+        server = await asyncio.start_server(
+            lambda reader, writer: on_recv_data(reader, writer, slots),
+            server_ip, server_port, backlog=max_clients,
+        )
         print("[INFO] Socket created at " + server_ip + ":" + str(server_port))
     except Exception as e:
         print("[FATAL] Socket Creation Failed!")
         print("Error Log: " + str(e))
         return
 
+    async with server:
+        await server.serve_forever()
+
+# Main Server function
+def main():
+    # Init GUI thread
+    if not args.no_gui:
+        init_GUI_thread = threading.Thread(target=init_GUI)
+        init_GUI_thread.start()
+
+        time.sleep(1)
+
+    # Start expiry scheduler thread
+    expiry_scheduler_thread = threading.Thread(target=expiry_scheduler)
+    expiry_scheduler_thread.daemon = True
+    expiry_scheduler_thread.start()
+
+    # Start forwarding updates to Flask server
+    forwarder.start()
+
+    # Serve metrics
+    if args.metrics_port:
+        try:
+            metrics.start_server(args.metrics_port, args.metrics_host)
+        except OSError as e:
+            print("[ERROR] Failed to start metrics server!")
+            print("Error Log: " + str(e))
+
     # Accept connections
-    while True:
-        c, addr = s.accept()
-        debug_print("[DEBUG] Accepted connection from " + str(addr))
-        thread = threading.Thread(target=on_recv_data, args=(c, addr))
-        thread.daemon = True
-        thread.start()
+    asyncio.run(serve())
 
 # Run
 if __name__ == "__main__":
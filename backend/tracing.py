@@ -0,0 +1,153 @@
+# tracing.py
+# In charge of recording per cycle spans of the client in --trace mode, and dumping them
+# in the Chrome trace format (open in chrome://tracing or ui.perfetto.dev)
+#
+# Every thread appends its spans to its own ring buffer, so recording never takes a lock
+# A background thread dumps all rings every interval, overwriting the previous dump
+# A signal (SIGUSR1) asks every traced thread to profile itself with cProfile for a while,
+# each thread starts at its next profile_point() and writes its own .prof file
+
+# Libraries
+import collections
+import contextlib
+import cProfile
+import json
+import os
+import signal
+import threading
+import time
+
+enabled = False
+ringSize = 10000                # Spans kept per thread
+rings = {}                      # Thread ID -> (thread name, deque of (name, category, start ns, duration ns))
+local = threading.local()
+
+# On demand profiling
+profileDir = None
+profileSeconds = 10
+profileRequest = 0              # Bumped by the signal, every thread profiles once per request
+
+NULL_SPAN = contextlib.nullcontext()
+
+
+def ring():
+    entry = getattr(local, "ring", None)
+    if entry is None:
+        thread = threading.current_thread()
+        entry = local.ring = collections.deque(maxlen=ringSize)
+        rings[thread.ident] = (thread.name, entry)  # Single dict store, safe without a lock
+    return entry
+
+
+class Span:
+    __slots__ = ("name", "category", "start")
+
+    def __init__(self, name : str, category : str):
+        self.name = name
+        self.category = category
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        ring().append((self.name, self.category, self.start, time.perf_counter_ns() - self.start))
+
+
+# Context manager recording a span, does nothing unless tracing is enabled
+def span(name : str, category="client"):
+    return Span(name, category) if enabled else NULL_SPAN
+
+
+# Record a span that took seconds and ended now, for code timed already
+def record(name : str, seconds : float, category="client"):
+    if enabled:
+        duration = int(seconds * 1e9)
+        ring().append((name, category, time.perf_counter_ns() - duration, duration))
+
+
+# All recorded spans as Chrome trace events
+def events():
+    pid = os.getpid()
+    traceEvents = []
+
+    for tid, (threadName, entries) in list(rings.items()):
+        traceEvents.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": threadName}})
+
+        for name, category, start, duration in list(entries):  # Copied in one go while holding the GIL
+            traceEvents.append({"name": name, "cat": category, "ph": "X", "pid": pid, "tid": tid, "ts": start / 1000, "dur": duration / 1000})
+
+    return traceEvents
+
+
+# Write all recorded spans to path, replacing it in one go so a reader never sees half a file
+def dump(path : str):
+    temp = path + ".tmp"
+    with open(temp, "w") as f:
+        json.dump({"traceEvents": events(), "displayTimeUnit": "ms"}, f)
+    os.replace(temp, path)
+
+
+def dumper(path : str, interval : float):
+    while True:
+        time.sleep(interval)
+
+        try:
+            dump(path)
+        except OSError as e:
+            print("[ERROR] Failed to write trace!")
+            print("Error Log: " + str(e))
+
+
+# Start tracing, dumping to directory/trace-<pid>.json every interval seconds
+def start(directory : str, interval=30, size=10000):
+    global enabled, ringSize, profileDir
+
+    os.makedirs(directory, exist_ok=True)
+    ringSize = size
+    profileDir = directory
+    enabled = True
+
+    thread = threading.Thread(target=dumper, args=(os.path.join(directory, f"trace-{os.getpid()}.json"), interval))
+    thread.daemon = True
+    thread.start()
+
+
+# Profile traced threads for seconds on SIGUSR1, must be called from the main thread
+def install_profile_signal(seconds=10):
+    global profileSeconds
+    profileSeconds = seconds
+
+    def request(signum, frame):
+        global profileRequest
+        profileRequest += 1
+        print(f"[INFO] Profiling traced threads for {profileSeconds} seconds...")
+
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, request)
+
+
+# Called by traced threads once per cycle, starts and stops profiling of the calling thread
+def profile_point():
+    if not enabled:
+        return
+
+    profiler = getattr(local, "profiler", None)
+    if profiler is None:
+        if getattr(local, "profileRequest", 0) == profileRequest:
+            return
+
+        local.profileRequest = profileRequest
+        local.profiler = cProfile.Profile()
+        local.profileStart = time.monotonic()
+        local.profiler.enable()
+        return
+
+    if time.monotonic() - local.profileStart >= profileSeconds:
+        profiler.disable()
+        local.profiler = None
+
+        name = threading.current_thread().name.replace(" ", "_")
+        path = os.path.join(profileDir, f"profile-{os.getpid()}-{name}-{int(time.time())}.prof")
+        profiler.dump_stats(path)
+        print("[INFO] Wrote profile " + path)
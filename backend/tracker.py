@@ -0,0 +1,181 @@
+# tracker.py
+# In charge of following heads between detector keyframes,
+# so counts can update faster than full inference allows
+
+# Libraries
+import collections
+import itertools
+
+import cv2
+import numpy as np
+
+
+# IoU between every box in a (n, 4) and every box in b (m, 4), xyxy
+def box_iou(a, b):
+    tl = np.maximum(a[:, None, :2], b[None, :, :2])
+    br = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.prod(np.clip(br - tl, 0, None), axis=2)
+
+    areaA = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    areaB = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    return inter / (areaA[:, None] + areaB[None, :] - inter + 1e-9)
+
+
+# Greedily match the highest scores first, returns list of (row, col)
+def greedy_match(scores, threshold):
+    matches = []
+    scores = scores.copy()
+
+    while scores.size:
+        row, col = np.unravel_index(scores.argmax(), scores.shape)
+        if scores[row, col] < threshold:
+            break
+
+        matches.append((row, col))
+        scores[row, :] = -np.inf
+        scores[:, col] = -np.inf
+
+    return matches
+
+
+# Single tracked head
+class Track:
+    def __init__(self, trackId : int, box, now : float):
+        self.trackId = trackId
+        self.box = np.float32(box)          # xyxy, pixels
+        self.velocity = np.zeros(2, np.float32)  # Centre pixels per second
+        self.firstSeen = now
+        self.lastSeen = now
+        self.lastUpdate = now
+        self.misses = 0
+        self.keyframes = 1      # Keyframes the head was detected on
+        self.occupancy = 0      # Sum of the people in view over those keyframes
+
+    def centre(self):
+        return (self.box[:2] + self.box[2:]) / 2
+
+    # Move box to a new centre, updating the velocity estimate
+    def moveTo(self, centre, now : float, smoothing=0.5):
+        dt = now - self.lastUpdate
+        if dt > 0:
+            self.velocity = smoothing * self.velocity + (1 - smoothing) * (centre - self.centre()) / dt
+
+        self.box = self.box + np.tile(centre - self.centre(), 2)
+        self.lastUpdate = now
+
+    # Constant velocity prediction of the box at time now
+    def predict(self, now : float):
+        return self.box + np.tile(self.velocity * (now - self.lastUpdate), 2)
+
+
+# Head Tracker Class
+# On keyframes, detections are matched to tracks by IoU (then centroid distance) against
+# the motion model prediction. Between keyframes, tracks are moved with sparse optical flow
+# Tracks that leave give the time spent in view (dwell time) of a person, and with the number
+# of people in view meanwhile, the time the queue takes per person (Little's law)
+# Only tracks detected on at least 2 keyframes count, so false positives and passers-by do not
+class Tracker:
+    def __init__(self, iouThreshold=0.3, maxMisses=2, dwellHistory=20):
+        self.iouThreshold = iouThreshold
+        self.maxMisses = maxMisses  # Keyframes a track may go undetected before it is dropped
+
+        self.tracks = []
+        self.ids = itertools.count()
+        self.dwellTimes = collections.deque(maxlen=dwellHistory)      # Seconds, of people who left
+        self.personTimes = collections.deque(maxlen=dwellHistory)     # Dwell time over mean people in view, of people who left
+
+        self.previousGrey = None
+
+    # Keyframe update with detected head boxes (n, 4), xyxy pixels
+    def update(self, boxes, image, now : float):
+        predicted = np.float32([track.predict(now) for track in self.tracks]).reshape(-1, 4)
+        boxes = np.float32(boxes).reshape(-1, 4)
+
+        matches = greedy_match(box_iou(predicted, boxes), self.iouThreshold)
+
+        # Centroid distance fallback, for fast moving heads with no overlap
+        matchedTracks = {t for t, _ in matches}
+        matchedBoxes = {b for _, b in matches}
+        unmatchedTracks = [t for t in range(len(self.tracks)) if t not in matchedTracks]
+        unmatchedBoxes = [b for b in range(len(boxes)) if b not in matchedBoxes]
+
+        if unmatchedTracks and unmatchedBoxes:
+            tracksCentre = (predicted[unmatchedTracks, :2] + predicted[unmatchedTracks, 2:]) / 2
+            boxesCentre = (boxes[unmatchedBoxes, :2] + boxes[unmatchedBoxes, 2:]) / 2
+            size = np.maximum(boxes[unmatchedBoxes, 2] - boxes[unmatchedBoxes, 0], boxes[unmatchedBoxes, 3] - boxes[unmatchedBoxes, 1])
+
+            # Score is 1 when centres overlap, 0 at one box size apart
+            distance = np.linalg.norm(tracksCentre[:, None] - boxesCentre[None], axis=2)
+            for t, b in greedy_match(1 - distance / size[None], 0.0):
+                matches.append((unmatchedTracks[t], unmatchedBoxes[b]))
+
+        matchedTracks = {t for t, _ in matches}
+        matchedBoxes = {b for _, b in matches}
+
+        for t, b in matches:
+            track = self.tracks[t]
+            track.moveTo((boxes[b, :2] + boxes[b, 2:]) / 2, now)
+            track.box = boxes[b].copy()
+            track.lastSeen = now
+            track.misses = 0
+            track.keyframes += 1
+            track.occupancy += len(boxes)
+
+        # Drop tracks that have not been seen for too long
+        alive = []
+        for t, track in enumerate(self.tracks):
+            if t not in matchedTracks:
+                track.misses += 1
+                if track.misses > self.maxMisses:
+                    if track.keyframes >= 2:
+                        dwell = track.lastSeen - track.firstSeen
+                        self.dwellTimes.append(dwell)
+                        self.personTimes.append(dwell / max(1.0, track.occupancy / track.keyframes))
+                    continue
+
+            alive.append(track)
+
+        # New people
+        for b in range(len(boxes)):
+            if b not in matchedBoxes:
+                track = Track(next(self.ids), boxes[b], now)
+                track.occupancy = len(boxes)
+                alive.append(track)
+
+        self.tracks = alive
+        self.previousGrey = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    # Between keyframes, move tracks with Lucas-Kanade optical flow of their centres
+    def propagate(self, image, now : float):
+        grey = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        if self.tracks and self.previousGrey is not None:
+            points = np.float32([track.centre() for track in self.tracks]).reshape(-1, 1, 2)
+            moved, status, _ = cv2.calcOpticalFlowPyrLK(self.previousGrey, grey, points, None, winSize=(21, 21), maxLevel=2)
+
+            for track, point, ok in zip(self.tracks, moved.reshape(-1, 2), status.reshape(-1)):
+                if ok:
+                    track.moveTo(point, now)
+                else:  # Lost by flow, fall back to the motion model
+                    box = track.predict(now)
+                    track.moveTo((box[:2] + box[2:]) / 2, now)
+
+        self.previousGrey = grey
+
+    # Number of people currently tracked
+    def count(self):
+        return len(self.tracks)
+
+    # Median time spent in view by people who left, None until someone has left
+    def dwellTime(self):
+        if not self.dwellTimes:
+            return None
+
+        return float(np.median(self.dwellTimes))
+
+    # Median seconds the queue takes per person ahead, None until someone has left
+    def personTime(self):
+        if not self.personTimes:
+            return None
+
+        return float(np.median(self.personTimes))
@@ -0,0 +1,65 @@
+# warp.py
+# In charge of flattening a stall out of the camera frame,
+# using a perspective remap table that is only built once
+
+# Libraries
+import hashlib
+import os
+
+import cv2
+import numpy as np
+
+
+# Perspective Warp Class
+# Precomputes the remap table for 4 cut positions (top left, top right, bottom right, bottom left)
+# Only the bounding box of the cut positions is read from the source image,
+# so the per-frame cost is a single fixed-point table lookup remap
+class Warp:
+    def __init__(self, imageCutPositions, width : int, height : int, cacheDir=None):
+        self.width = width
+        self.height = height
+
+        pts0 = np.float32(imageCutPositions)
+
+        # Bounding box of the cut positions, in source image coordinates
+        self.x0, self.y0 = [max(int(v), 0) for v in np.floor(pts0.min(axis=0))]
+        self.x1, self.y1 = [int(v) + 2 for v in np.ceil(pts0.max(axis=0))]  # +2 for bilinear neighbours
+
+        # Load cached maps if available
+        cachePath = None
+        if cacheDir is not None:
+            key = hashlib.sha1(pts0.tobytes() + np.int32([width, height]).tobytes()).hexdigest()
+            cachePath = os.path.join(cacheDir, f"warp_{key}.npz")
+
+            if os.path.exists(cachePath):
+                cached = np.load(cachePath)
+                self.map1, self.map2 = cached["map1"], cached["map2"]
+                return
+
+        self.map1, self.map2 = self._buildMaps(pts0)
+
+        if cachePath is not None:
+            os.makedirs(cacheDir, exist_ok=True)
+            np.savez(cachePath, map1=self.map1, map2=self.map2)
+
+    # Build fixed-point remap maps from output pixels to (cropped) source pixels
+    def _buildMaps(self, pts0):
+        pts1 = np.float32([[0,0],[self.width,0],[self.width,self.height],[0,self.height]])
+
+        # Inverse transform, output image -> source image
+        M = cv2.getPerspectiveTransform(pts1, pts0).astype(np.float64)
+
+        xs, ys = np.meshgrid(np.arange(self.width, dtype=np.float64), np.arange(self.height, dtype=np.float64))
+        w = M[2, 0] * xs + M[2, 1] * ys + M[2, 2]
+        mapX = (M[0, 0] * xs + M[0, 1] * ys + M[0, 2]) / w - self.x0
+        mapY = (M[1, 0] * xs + M[1, 1] * ys + M[1, 2]) / w - self.y0
+
+        return cv2.convertMaps(mapX.astype(np.float32), mapY.astype(np.float32), cv2.CV_16SC2)
+
+    # Flatten the stall out of image
+    def apply(self, image):
+        crop = image[self.y0:self.y1, self.x0:self.x1]
+        if crop.size == 0:  # Cut positions entirely outside of image
+            return np.zeros((self.height, self.width) + image.shape[2:], dtype=image.dtype)
+
+        return cv2.remap(crop, self.map1, self.map2, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
@@ -0,0 +1,178 @@
+# history.py
+# In charge of keeping the queue time history of every stall,
+# so queue times over a whole term can be looked back on for capacity planning
+
+# Libraries
+import collections
+import queue
+import sqlite3
+import threading
+import time
+
+# Rollup resolutions, name -> bucket size in seconds
+RESOLUTIONS = {"1m": 60, "15m": 900, "1h": 3600}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    stall TEXT NOT NULL,
+    time REAL NOT NULL,
+    minutes REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_stall_time ON samples (stall, time);
+
+CREATE TABLE IF NOT EXISTS rollups (
+    resolution TEXT NOT NULL,
+    stall TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    total REAL NOT NULL,
+    min REAL NOT NULL,
+    max REAL NOT NULL,
+    PRIMARY KEY (resolution, stall, bucket)
+) WITHOUT ROWID;
+"""
+
+# Adds a sample to an existing bucket, or starts a new one
+UPSERT_ROLLUP = """
+INSERT INTO rollups (resolution, stall, bucket, count, total, min, max) VALUES (?, ?, ?, 1, ?, ?, ?)
+ON CONFLICT (resolution, stall, bucket) DO UPDATE SET
+    count = count + 1,
+    total = total + excluded.total,
+    min = MIN(min, excluded.min),
+    max = MAX(max, excluded.max)
+"""
+
+
+# Queue time as displayed ("~3", "0.9") to minutes, None if it is not a queue time
+def queue_minutes(queueTime):
+    try:
+        return float(str(queueTime).lstrip("~"))
+    except ValueError:
+        return None
+
+
+# Queue History Class
+# record() only appends to an in-memory ring buffer per stall and hands the sample to a
+# writer thread, so it is cheap enough to call while holding the timings lock
+# The writer thread stores raw samples in SQLite (WAL mode, so reads never wait on it) and
+# keeps the 1 minute / 15 minute / hourly rollups up to date as samples come in,
+# so range queries read at most one row per bucket instead of scanning raw samples
+# Raw samples older than retentionDays are pruned, rollups are kept
+class History:
+    def __init__(self, path : str, ringSize=1024, retentionDays=14, batchSize=256):
+        self.path = path
+        self.retention = retentionDays * 86400
+        self.batchSize = batchSize
+
+        self.rings = collections.defaultdict(lambda: collections.deque(maxlen=ringSize))  # Stall -> (time, minutes)
+        self.ringsLock = threading.Lock()
+        self.pending = queue.Queue()
+        self.local = threading.local()  # Read connection per thread
+        self.thread = None
+
+        # Stats
+        self.recorded = 0
+        self.written = 0
+
+        # Create tables before any reads
+        db = self._open()
+        db.executescript(SCHEMA)
+        db.close()
+
+    def _open(self):
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")  # Safe with WAL, only the last commits can be lost on power loss
+        return db
+
+    # Start the writer thread
+    def start(self):
+        if self.thread is not None:
+            return
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Record a queue time update of a stall, values that are not queue times are ignored
+    def record(self, stall : str, queueTime, timestamp=None):
+        minutes = queue_minutes(queueTime)
+        if minutes is None:
+            return
+
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.ringsLock:
+            self.rings[stall].append((timestamp, minutes))
+
+        self.pending.put((stall, timestamp, minutes))
+        self.recorded += 1
+
+    # Writer thread, writes samples in batches of one transaction each
+    def _run(self):
+        db = self._open()
+        lastPrune = 0
+
+        while True:
+            batch = [self.pending.get()]
+            while len(batch) < self.batchSize:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                with db:
+                    db.executemany("INSERT INTO samples (stall, time, minutes) VALUES (?, ?, ?)", batch)
+                    db.executemany(UPSERT_ROLLUP, [
+                        (resolution, stall, int(timestamp // size) * size, minutes, minutes, minutes)
+                        for stall, timestamp, minutes in batch
+                        for resolution, size in RESOLUTIONS.items()
+                    ])
+                self.written += len(batch)
+            except sqlite3.Error as e:
+                print("[ERROR] Failed to write queue history!")
+                print("Error Log: " + str(e))
+
+            # Prune raw samples about once an hour
+            if time.time() - lastPrune > 3600:
+                lastPrune = time.time()
+                try:
+                    with db:
+                        db.execute("DELETE FROM samples WHERE time < ?", (lastPrune - self.retention,))
+                except sqlite3.Error as e:
+                    print("[ERROR] Failed to prune queue history!")
+                    print("Error Log: " + str(e))
+
+    def _reader(self):
+        if not hasattr(self.local, "db"):
+            self.local.db = self._open()
+        return self.local.db
+
+    # Pick the finest resolution that keeps a range under maxPoints points
+    def pickResolution(self, start : float, end : float, maxPoints=500):
+        for resolution, size in RESOLUTIONS.items():
+            if (end - start) / size <= maxPoints:
+                return resolution
+        return "1h"
+
+    # Queue times of a stall between start and end (seconds since epoch)
+    # "raw" gives [time, minutes] samples, served from memory if the ring buffer covers the range
+    # Rollups give [bucket start, count, mean, min, max] per bucket
+    def query(self, stall : str, start : float, end : float, resolution : str):
+        if resolution == "raw":
+            with self.ringsLock:
+                ring = list(self.rings.get(stall, ()))
+
+            if ring and ring[0][0] <= start:
+                return [[t, minutes] for t, minutes in ring if start <= t <= end]
+
+            rows = self._reader().execute(
+                "SELECT time, minutes FROM samples WHERE stall = ? AND time BETWEEN ? AND ? ORDER BY time",
+                (stall, start, end))
+            return [list(row) for row in rows]
+
+        size = RESOLUTIONS[resolution]
+        rows = self._reader().execute(
+            "SELECT bucket, count, total, min, max FROM rollups WHERE resolution = ? AND stall = ? AND bucket BETWEEN ? AND ? ORDER BY bucket",
+            (resolution, stall, int(start // size) * size, end))
+        return [[bucket, count, round(total / count, 2), low, high] for bucket, count, total, low, high in rows]
@@ -0,0 +1,242 @@
+# state.py
+# In charge of storing the queue time of every stall for the webserver,
+# so the same state can be served by one or many worker processes
+#
+# Every backend keeps, per canteen, a version bumped on every change and
+# per stall [queue time, monotonic time of last update]
+# Monotonic time is shared by every process on the machine, so all backends are meant to be local
+#   local:          dicts in this process, for a single worker
+#   shared_memory:  fixed layout records in a shared memory segment, made before workers are forked
+#   redis:          a local Redis compatible server, needs the redis package
+# Updates are applied by a single writer at a time, readers never take the writer lock
+
+# Libraries
+import json
+import multiprocessing
+import os
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+
+BACKENDS = ["local", "shared_memory", "redis"]
+
+MAX_QUEUE_TIME = 16  # Bytes, queue times are short strings like "~3"
+UNKNOWN = "???"
+
+
+# Local State Class
+# Process-local state, the writer lock is a thread lock
+class LocalState:
+    def __init__(self, registry):
+        self.timings = {name: {stall.name: [UNKNOWN, time.monotonic()] for stall in stalls} for name, stalls in registry.canteens.items()}
+        self.versions = dict.fromkeys(registry.canteens, 0)
+        self.lock = threading.Lock()
+
+    def version(self, canteen : str):
+        return self.versions[canteen]
+
+    # Returns (version, {stall: [queue time, last update]}), consistent with each other
+    def snapshot(self, canteen : str):
+        with self.lock:
+            return self.versions[canteen], {stall: list(info) for stall, info in self.timings[canteen].items()}
+
+    # Apply updates of (canteen, stall, queue time) together
+    def update(self, updates):
+        now = time.monotonic()
+        with self.lock:
+            for canteen, stall, queueTime in updates:
+                self.timings[canteen][stall] = [queueTime, now]
+                self.versions[canteen] += 1
+
+    # Clear the queue time of a stall not updated for threshold seconds
+    # Returns the time of the last update if it is still fresh, so expiry can be scheduled again, else None
+    def expire(self, canteen : str, stall : str, threshold : float):
+        with self.lock:
+            info = self.timings[canteen][stall]
+            if time.monotonic() - info[1] < threshold:
+                return info[1]
+
+            if info[0] != UNKNOWN:
+                info[0] = UNKNOWN
+                self.versions[canteen] += 1
+            return None
+
+    def close(self):
+        pass
+
+
+# Shared Memory State Class
+# One block per canteen: a sequence number, then a fixed size record per stall
+#   sequence (Q) | stall record (16s d) ...
+# The sequence number is a seqlock: the writer makes it odd before writing a block and even after,
+# readers copy the block and retry if the sequence number was odd or changed meanwhile,
+# yielding between retries and giving up after MAX_RETRIES, in case a writer died mid-update
+# The version of a canteen is half its sequence number, so it is read without copying the block
+# Must be made before workers are forked, they share the segment and the writer lock
+class SharedMemoryState:
+    SEQ = struct.Struct("Q")
+    RECORD = struct.Struct(f"{MAX_QUEUE_TIME}sd")
+    MAX_RETRIES = 10000
+
+    def __init__(self, registry):
+        self.stalls = {}   # Canteen -> stall names, in record order
+        self.offsets = {}  # Canteen -> offset of its block
+        self.records = {}  # (canteen, stall) -> offset of its record
+
+        size = 0
+        for name, stalls in registry.canteens.items():
+            self.stalls[name] = [stall.name for stall in stalls]
+            self.offsets[name] = size
+            size += self.SEQ.size
+            for stall in stalls:
+                self.records[(name, stall.name)] = size
+                size += self.RECORD.size
+
+        self.memory = shared_memory.SharedMemory(create=True, size=size)
+        self.buffer = self.memory.buf
+        self.lock = multiprocessing.Lock()
+        self.owner = os.getpid()  # Only the process that made the segment removes it, not forked workers
+
+        now = time.monotonic()
+        for (name, stall), offset in self.records.items():
+            self.RECORD.pack_into(self.buffer, offset, UNKNOWN.encode(), now)
+
+    def version(self, canteen : str):
+        return self.SEQ.unpack_from(self.buffer, self.offsets[canteen])[0] // 2
+
+    def snapshot(self, canteen : str):
+        start = self.offsets[canteen]
+        end = start + self.SEQ.size + len(self.stalls[canteen]) * self.RECORD.size
+
+        for _ in range(self.MAX_RETRIES):
+            before = self.SEQ.unpack_from(self.buffer, start)[0]
+            if before % 2 == 0:  # No write in progress
+                block = bytes(self.buffer[start:end])
+                if self.SEQ.unpack_from(self.buffer, start)[0] == before:
+                    break
+
+            time.sleep(0)  # Let the writer, or other greenlets, run
+        else:
+            raise RuntimeError(f"State of {canteen} is stuck mid-update, was a writer killed?")
+
+        timings = {}
+        for i, stall in enumerate(self.stalls[canteen]):
+            queueTime, lastUpdate = self.RECORD.unpack_from(block, self.SEQ.size + i * self.RECORD.size)
+            timings[stall] = [queueTime.rstrip(b"\0").decode(), lastUpdate]
+
+        return before // 2, timings
+
+    # Begin or end writing the block of a canteen, must be called with the writer lock held
+    def _bump(self, canteen : str):
+        offset = self.offsets[canteen]
+        self.SEQ.pack_into(self.buffer, offset, self.SEQ.unpack_from(self.buffer, offset)[0] + 1)
+
+    def update(self, updates):
+        now = time.monotonic()
+        with self.lock:
+            canteens = {canteen for canteen, _, _ in updates}
+            for canteen in canteens:
+                self._bump(canteen)
+
+            for canteen, stall, queueTime in updates:
+                self.RECORD.pack_into(self.buffer, self.records[(canteen, stall)], queueTime.encode()[:MAX_QUEUE_TIME], now)
+
+            for canteen in canteens:
+                self._bump(canteen)
+
+    def expire(self, canteen : str, stall : str, threshold : float):
+        offset = self.records[(canteen, stall)]
+
+        with self.lock:
+            queueTime, lastUpdate = self.RECORD.unpack_from(self.buffer, offset)
+            if time.monotonic() - lastUpdate < threshold:
+                return lastUpdate
+
+            if queueTime.rstrip(b"\0").decode() != UNKNOWN:
+                self._bump(canteen)
+                self.RECORD.pack_into(self.buffer, offset, UNKNOWN.encode(), lastUpdate)
+                self._bump(canteen)
+            return None
+
+    # Remove the segment, only does anything in the process that made it
+    def close(self):
+        if os.getpid() == self.owner:
+            self.buffer = None
+            self.memory.close()
+            self.memory.unlink()
+
+
+# Redis State Class
+# A hash of stall -> JSON [queue time, last update] and a version counter per canteen
+# Updates and expiry are MULTI/EXEC transactions, so every process can write and readers see whole updates
+class RedisState:
+    def __init__(self, registry, url : str, prefix="cq"):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.client.ping()  # Fail on startup, not on the first request
+
+        # Start from a clean state, like the other backends
+        now = time.monotonic()
+        pipe = self.client.pipeline()
+        for name, stalls in registry.canteens.items():
+            pipe.delete(self._key(name))
+            pipe.hset(self._key(name), mapping={stall.name: json.dumps([UNKNOWN, now]) for stall in stalls})
+            pipe.setnx(self._key(name) + ":version", 0)
+        pipe.execute()
+
+    def _key(self, canteen : str):
+        return f"{self.prefix}:{canteen}"
+
+    def version(self, canteen : str):
+        return int(self.client.get(self._key(canteen) + ":version") or 0)
+
+    def snapshot(self, canteen : str):
+        pipe = self.client.pipeline()  # Transaction by default
+        pipe.get(self._key(canteen) + ":version")
+        pipe.hgetall(self._key(canteen))
+        version, timings = pipe.execute()
+
+        return int(version or 0), {stall.decode(): json.loads(info) for stall, info in timings.items()}
+
+    def update(self, updates):
+        now = time.monotonic()
+        pipe = self.client.pipeline()
+        for canteen, stall, queueTime in updates:
+            pipe.hset(self._key(canteen), stall, json.dumps([queueTime, now]))
+            pipe.incr(self._key(canteen) + ":version")
+        pipe.execute()
+
+    def expire(self, canteen : str, stall : str, threshold : float):
+        key = self._key(canteen)
+        result = {}
+
+        # Retried by redis-py if the stall is updated between the read and the write
+        def clear(pipe):
+            queueTime, lastUpdate = json.loads(pipe.hget(key, stall))
+            result["lastUpdate"] = lastUpdate if time.monotonic() - lastUpdate < threshold else None
+
+            if result["lastUpdate"] is None and queueTime != UNKNOWN:
+                pipe.multi()
+                pipe.hset(key, stall, json.dumps([UNKNOWN, lastUpdate]))
+                pipe.incr(key + ":version")
+
+        self.client.transaction(clear, key)
+        return result["lastUpdate"]
+
+    def close(self):
+        self.client.close()
+
+
+# Make the state backend with the given name
+def make_state(name : str, registry, redisUrl=None):
+    if name == "local":
+        return LocalState(registry)
+    elif name == "shared_memory":
+        return SharedMemoryState(registry)
+    elif name == "redis":
+        return RedisState(registry, redisUrl)
+
+    raise ValueError(f"Unknown state backend: {name}")
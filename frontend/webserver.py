@@ -1,24 +1,52 @@
 # Flask Webserver to display Canteen Queue Times
 # Updated via a POST request to /api/update_timing
-# Displayed via GET request to /
-# / should auto refresh once every minute
+# Displayed via GET request to / (default canteen) or /canteen/<canteen>
+# Pages are kept up to date by server push from /api/stream, or poll /api/get_timing
+# Queue times are kept in a state backend (state.py), so several worker processes can serve them
 
 # Libraries
 import flask
-from flask import jsonify, render_template, request
+from flask import g, jsonify, render_template, request, Response
+import gevent
 from gevent.pywsgi import WSGIServer
+from gevent.queue import Queue, Empty
 
 import os
+import signal
+import sys
 import time
 import threading
+import heapq
+import json
+import math
 
 import argparse
 
+from history import History, RESOLUTIONS
+from state import BACKENDS, MAX_QUEUE_TIME, make_state
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../misc"))
+import metrics
+from registry import RegistryError, load_registry
+
 # Parse Arguments
 parser = argparse.ArgumentParser(description='Canteen Queue Counter Webserver')
 parser.add_argument('--debug', default=False, action="store_true", help='Turns on debug server')
+parser.add_argument('--port', type=int, default=80, help='Port to serve on')
+parser.add_argument('--history', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "history.db"), help='SQLite file to keep queue time history in')
+parser.add_argument('--history_retention', type=int, default=14, help='Days to keep raw history for, rollups are kept forever')
+parser.add_argument('--registry', type=str, default=None, help='Stall registry file, misc/stalls.json by default')
+parser.add_argument('--state', type=str, default="local", choices=BACKENDS, help='Where queue times are kept, shared_memory or redis to serve them from several workers')
+parser.add_argument('--redis_url', type=str, default="redis://localhost:6379/0", help='Redis server of the redis state backend')
+parser.add_argument('--metrics_port', type=int, default=9103, help='Port to serve Prometheus metrics on, the next ports for further workers, 0 to turn off')
+parser.add_argument('--metrics_host', type=str, default="127.0.0.1", help='Address to serve Prometheus metrics on, 0.0.0.0 for remote scraping')
+parser.add_argument('--workers', type=int, default=1, help='Number of worker processes serving requests, more than 1 needs a shared state backend')
 args = parser.parse_args()
 
+if args.workers > 1 and (args.state == "local" or args.debug):
+    print("[FATAL] Several workers need a shared state backend and the production server")
+    sys.exit(1)
+
 # Flask init
 app = flask.Flask(__name__)
 app.config["DEBUG"] = args.debug
@@ -27,37 +55,182 @@ app.config["DEBUG"] = args.debug
 
 update_threshold = 60   # Time before display shows "???"
 
+broadcast_interval = 0.5   # Seconds between checks for changed stalls to push
+keepalive_interval = 15    # Seconds between keepalive comments on idle streams
+
 # Authentication key and token
 auth_key = os.environ["QUEUE_AUTH_KEY"]
 auth_token = os.environ["QUEUE_AUTH_TOKEN"]
 
-# Stall names
-stall_names = ["Drinks", "Snacks", "Malay 1", "Malay 2", "Western", "Chicken Rice", "Oriental Taste", "CLOSED"]
+# Canteens and stalls, from the stall registry
+try:
+    registry = load_registry(args.registry)
+except RegistryError as e:
+    print("[FATAL] " + str(e))
+    sys.exit(1)
 
-# Canteen queue times dict, passed to index.html
+# Canteen queue times, per canteen: a version bumped on every change of what viewers see
+# and per stall [Queue Time, Monotonic Time Of Last Update]
 # Updated by POST request to /api/update_timing
-timings = {}
+try:
+    state = make_state(args.state, registry, redisUrl=args.redis_url)
+except Exception as e:
+    print("[FATAL] Failed to start " + args.state + " state backend!")
+    print("Error Log: " + str(e))
+    sys.exit(1)
 
-# Init timings
-for stall in stall_names:
-    timings[stall] = ["???", 0]  # [Queue Time, Time Since Last Update]
+# Canteen Shard Class
+# Per worker view of a single canteen. Every canteen has its own version in the state backend,
+# response cache and stream subscribers, so viewers of one canteen never wait on another
+class Shard:
+    def __init__(self, name : str, stalls):
+        self.name = name
+        self.stallNames = [stall.name for stall in stalls]
+        self.stallIds = {stall.name: stall.stallId for stall in stalls}  # Hashed lookups, for validation
 
-# Last Update Checker
-def last_update_checker():
-    while True:
-        time.sleep(1)
-        for stall_name, stall_info in timings.items():
-            stall_info[1] += 1
-            if stall_info[1] >= update_threshold and stall_info[0] != "???":
-                timings[stall_name][0] = "???"
+        # Responses are cached per version, and ETags are made from it
+        self.cache = {}  # Key -> (version, body)
+
+        # Viewers of /api/stream, every one has a queue filled by the broadcaster greenlet
+        self.subscribers = set()
+
+shards = {name: Shard(name, stalls) for name, stalls in registry.canteens.items()}
+
+# Queue time history, for /api/history
+# Recent samples are only kept in memory with a single worker, it would only see its own updates otherwise
+history = History(args.history, ringSize=1024 if args.workers == 1 else 0, retentionDays=args.history_retention)
+
+state_epoch = str(int(time.time()))  # Keeps ETags from a previous run from matching
+
+# Metrics, served on --metrics_port by every worker
+request_seconds = metrics.Histogram("webserver_request_seconds", "Seconds per request", ("endpoint", "method", "status"))
+updates_applied = metrics.Counter("webserver_updates_total", "Stall updates applied, per canteen", ("canteen",))
+
+# Seconds since the last update of every stall, read when scraped
+def stall_ages():
+    now = time.monotonic()
+    return {(name, stall_name): round(now - last_update, 3) for name in shards for stall_name, (queue_time, last_update) in state.snapshot(name)[1].items()}
+
+metrics.Gauge("webserver_stall_age_seconds", "Seconds since the last update of a stall", ("canteen", "stall"), function=stall_ages)
+
+# Expiry scheduler state, min-heap of (time stall goes stale, canteen, stall)
+# A stall has at most one entry, so the heap never grows past the number of stalls
+# Every worker schedules expiry of the updates it applied
+expiry_heap = []
+expiry_scheduled = set()
+expiry_condition = threading.Condition()
+
+# Shard of the canteen named in a request, the default canteen if none is named, None if unknown
+def request_shard():
+    return shards.get(request.args.get("canteen") or registry.defaultCanteen)
+
+# Get timings of a canteen with staleness evaluated now, passed to index.html
+# Format: {stall: [Queue Time, Seconds Since Last Update]}
+def current_timings(shard):
+    now = time.monotonic()
+    current = {}
+
+    for stall_name, (queue_time, last_update) in state.snapshot(shard.name)[1].items():
+        age = int(now - last_update)
+        current[stall_name] = [queue_time if age < update_threshold else "???", age]
+
+    return current
+
+# Set queue times of (shard, stall, queue time) together, scheduling them to go stale
+def set_timings(updates):
+    state.update([(shard.name, stall_name, queue_time) for shard, stall_name, queue_time in updates])
+    now = time.monotonic()
+
+    with expiry_condition:
+        for shard, stall_name, queue_time in updates:
+            history.record(f"{shard.name}/{stall_name}", queue_time)
+            updates_applied.inc(shard.name)
+
+            if (shard.name, stall_name) not in expiry_scheduled:
+                expiry_scheduled.add((shard.name, stall_name))
+                heapq.heappush(expiry_heap, (now + update_threshold, shard.name, stall_name))
+                expiry_condition.notify()
+
+# Expiry scheduler, only wakes up when the next stall goes stale
+# Reads are already lazy, this clears the stored queue time of stale stalls
+def expiry_scheduler():
+    with expiry_condition:
+        while True:
+            if not expiry_heap:
+                expiry_condition.wait()
+                continue
+
+            now = time.monotonic()
+            deadline, canteen, stall_name = expiry_heap[0]
+            if deadline > now:
+                expiry_condition.wait(deadline - now)
+                continue
+
+            heapq.heappop(expiry_heap)
+
+            # Updated since it was scheduled, reschedule from the last update
+            last_update = state.expire(canteen, stall_name, update_threshold)
+            if last_update is not None:
+                heapq.heappush(expiry_heap, (last_update + update_threshold, canteen, stall_name))
+                continue
+
+            expiry_scheduled.discard((canteen, stall_name))
+
+# Get response body for the current version of a canteen, only rendering it once per version
+# NOTE: Seconds since last update in a cached body are as of when it was rendered
+def cached_body(shard, key, render):
+    version = state.version(shard.name)
+    entry = shard.cache.get(key)
+
+    if entry is None or entry[0] != version:
+        entry = (version, render())
+        shard.cache[key] = entry
+
+    return entry
+
+# Response for the current version of a canteen, with a strong ETag and 304 Not Modified handling
+def versioned_response(shard, key, render, mimetype):
+    version, body = cached_body(shard, key, render)
+    etag = f"{key}-{state_epoch}-{version}"
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype=mimetype)
+
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"  # Always revalidate
+    return response
+
+# Request metrics
+@app.before_request
+def start_timer():
+    g.start_time = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unknown"
+    request_seconds.observe(time.perf_counter() - g.start_time, endpoint, request.method, str(response.status_code))
+    return response
 
 # index.html
+def render_index(shard):
+    return versioned_response(shard, "index", lambda: render_template("index.html", canteen=shard.name, timings=current_timings(shard)), "text/html")
+
 @app.route("/", methods=["GET"])
 def index():
-    return render_template("index.html", timings=timings)
+    return render_index(shards[registry.defaultCanteen])
+
+@app.route("/canteen/<canteen>", methods=["GET"])
+def canteen_index(canteen):
+    if canteen not in shards:
+        return "Invalid canteen", 404
+
+    return render_index(shards[canteen])
 
 # API
 # Update timings
+# canteen is optional, the default canteen if not given
 @app.route("/api/update_timing", methods=["POST"])
 def update_timing():
     # Check if auth key and token in request
@@ -67,51 +240,270 @@ def update_timing():
     if request.headers[auth_key] != auth_token:
         return "Invalid authentication token", 400
 
+    shard = request_shard()
+    if shard is None:
+        return "Invalid canteen", 400
+
     # Check if canteen stall name and queue time in request
     if "stall_name" not in request.args:
         return "Missing stall name", 400
-    
-    if request.args["stall_name"] not in stall_names:
+
+    if request.args["stall_name"] not in shard.stallIds:
         return "Invalid stall name", 400
 
     if "queue_time" not in request.args:
         return "Missing queue time", 400
 
+    if len(request.args["queue_time"].encode()) > MAX_QUEUE_TIME:
+        return "Queue time too long", 400
+
     # Update timings
-    timings[request.args["stall_name"]][0] = request.args["queue_time"]
-    timings[request.args["stall_name"]][1] = 0
+    set_timings([(shard, request.args["stall_name"], request.args["queue_time"])])
 
     return "Successfully updated timings", 200
 
+# Update timings of many stalls at once
+# Body is JSON: {"updates": [{"canteen": <optional>, "stall_name": ..., "queue_time": ...}, ...]}
+# Every update is validated first, then all of them are applied together, or none are
+# On a bad update, the response is {"errors": [...], "invalid": [indices of bad updates]}, so the rest can be sent again
+@app.route("/api/update_timings", methods=["POST"])
+def update_timings():
+    # Check if auth key and token in request
+    if auth_key not in request.headers:
+        return "Invalid authentication key", 400
+
+    if request.headers[auth_key] != auth_token:
+        return "Invalid authentication token", 400
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("updates"), list):
+        return "Missing updates", 400
+
+    # Validate all updates in one pass
+    updates = []
+    errors = []
+    invalid = []
+    for i, update in enumerate(body["updates"]):
+        if not isinstance(update, dict):
+            errors.append(f"{i}: Invalid update")
+            invalid.append(i)
+            continue
+
+        shard = shards.get(update.get("canteen") or registry.defaultCanteen)
+        if shard is None:
+            errors.append(f"{i}: Invalid canteen")
+        elif update.get("stall_name") not in shard.stallIds:
+            errors.append(f"{i}: Invalid stall name")
+        elif "queue_time" not in update:
+            errors.append(f"{i}: Missing queue time")
+        elif len(str(update["queue_time"]).encode()) > MAX_QUEUE_TIME:
+            errors.append(f"{i}: Queue time too long")
+        else:
+            updates.append((shard, update["stall_name"], str(update["queue_time"])))
+            continue
+
+        invalid.append(i)
+
+    if errors:
+        return jsonify({"errors": errors, "invalid": invalid}), 400
+
+    # Apply atomically
+    set_timings(updates)
+
+    return f"Successfully updated {len(updates)} timings", 200
+
 # Get timings
+# canteen is optional, the default canteen if not given
 @app.route("/api/get_timing", methods=["GET"])
 def get_timing():
+    shard = request_shard()
+    if shard is None:
+        return "Invalid canteen", 400
+
     # Check if stall name in request
     if "stall_name" not in request.args:
         return "Missing stall name", 400
 
     # Check if stall name is all
     if request.args["stall_name"] == "all":
-        return jsonify(timings), 200
+        return versioned_response(shard, "all", lambda: json.dumps(current_timings(shard), sort_keys=True), "application/json")
 
     # Check if stall name is valid
-    if request.args["stall_name"] not in stall_names:
+    if request.args["stall_name"] not in shard.stallIds:
         return "Invalid stall name", 400
 
     # Return queue time
-    return timings[request.args["stall_name"]][0], 200
+    stall_name = request.args["stall_name"]
+    return versioned_response(shard, f"stall-{shard.stallIds[stall_name]}", lambda: current_timings(shard)[stall_name][0], "text/html")
 
-# Run server
-if __name__ == "__main__":
-    # Start last update checker thread
-    thread = threading.Thread(target=last_update_checker)
+# Get queue time history of a stall
+# canteen is optional, the default canteen if not given
+# start and end are seconds since epoch, the last hour by default
+# resolution is raw, 1m, 15m or 1h, picked from the length of the range by default
+@app.route("/api/history", methods=["GET"])
+def get_history():
+    shard = request_shard()
+    if shard is None:
+        return "Invalid canteen", 400
+
+    # Check if stall name in request
+    if "stall_name" not in request.args:
+        return "Missing stall name", 400
+
+    if request.args["stall_name"] not in shard.stallIds:
+        return "Invalid stall name", 400
+
+    try:
+        end = float(request.args.get("end", time.time()))
+        start = float(request.args.get("start", end - 3600))
+    except ValueError:
+        return "Invalid start or end", 400
+
+    if not (math.isfinite(start) and math.isfinite(end)):
+        return "Invalid start or end", 400
+
+    if start > end:
+        return "Start is after end", 400
+
+    resolution = request.args.get("resolution", history.pickResolution(start, end))
+    if resolution != "raw" and resolution not in RESOLUTIONS:
+        return "Invalid resolution", 400
+
+    # Raw samples are only for short ranges, rollups answer the rest
+    if resolution == "raw" and end - start > 86400:
+        return "Raw history is limited to one day, use a rollup resolution", 400
+
+    columns = ["time", "minutes"] if resolution == "raw" else ["time", "count", "mean", "min", "max"]
+    return jsonify({
+        "canteen": shard.name,
+        "stall_name": request.args["stall_name"],
+        "resolution": resolution,
+        "columns": columns,
+        "points": history.query(f"{shard.name}/{request.args['stall_name']}", start, end, resolution),
+    }), 200
+
+# Server push
+# Broadcaster, pushes only the stalls whose queue time changed to every subscriber of their canteen
+def broadcaster():
+    previous = {name: {stall_name: stall_info[0] for stall_name, stall_info in current_timings(shard).items()} for name, shard in shards.items()}
+    versions = {name: state.version(name) for name in shards}
+
+    while True:
+        gevent.sleep(broadcast_interval)
+
+        for name, shard in shards.items():
+            # Nothing changed
+            version = state.version(name)
+            if version == versions[name]:
+                continue
+            versions[name] = version
+
+            current = current_timings(shard)
+            changed = {stall_name: stall_info for stall_name, stall_info in current.items() if stall_info[0] != previous[name][stall_name]}
+            if not changed:
+                continue
+
+            previous[name] = {stall_name: stall_info[0] for stall_name, stall_info in current.items()}
+            message = f"data: {json.dumps(changed)}\n\n"
+
+            for subscriber in list(shard.subscribers):
+                subscriber.put(message)
+
+# Stream of changed timings of a canteen, as Server-Sent Events
+# canteen is optional, the default canteen if not given
+@app.route("/api/stream", methods=["GET"])
+def stream():
+    # Pushing needs the gevent server, the page falls back to polling
+    if args.debug:
+        return "Streaming is only available in production mode", 503
+
+    shard = request_shard()
+    if shard is None:
+        return "Invalid canteen", 400
+
+    def events():
+        subscriber = Queue()
+        shard.subscribers.add(subscriber)
+
+        try:
+            # Full state first, then only changes
+            yield f"data: {json.dumps(current_timings(shard))}\n\n"
+
+            while True:
+                try:
+                    yield subscriber.get(timeout=keepalive_interval)
+                except Empty:
+                    yield ": keepalive\n\n"
+        finally:
+            shard.subscribers.discard(subscriber)
+
+    return Response(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Start background threads of a worker, workers are numbered from 0
+def start_worker(worker=0):
+    # Start expiry scheduler thread
+    thread = threading.Thread(target=expiry_scheduler)
     thread.daemon = True
     thread.start()
 
+    # Start history writer thread
+    history.start()
+
+    # Serve metrics of this worker
+    if args.metrics_port:
+        try:
+            metrics.start_server(args.metrics_port + worker, args.metrics_host)
+        except OSError as e:
+            print("[ERROR] Failed to start metrics server!")
+            print("Error Log: " + str(e))
+
+# Serve from several pre-forked workers, all accepting on the listening socket of http_server
+# Queue times are shared through the state backend, everything else is per worker
+def serve_workers(http_server):
+    http_server.init_socket()
+    workers = []
+
+    for worker in range(args.workers):
+        pid = gevent.fork()
+        if pid == 0:
+            start_worker(worker)
+            gevent.spawn(broadcaster)
+            http_server.serve_forever()
+            os._exit(0)
+
+        workers.append(pid)
+
+    print(f"[INFO] Started {len(workers)} workers")
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        for _ in workers:
+            pid, status = os.wait()
+            print(f"[ERROR] Worker {pid} exited with status {status}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        state.close()
+
+# Run server
+if __name__ == "__main__":
     # Run Flask server
     if args.debug:
-        app.run(host="0.0.0.0", port=80)  # Debug mode
+        start_worker()
+        app.run(host="0.0.0.0", port=args.port)  # Debug mode
+    elif args.workers > 1:
+        print("[INFO] Initializing server...")
+        http_server = WSGIServer(("0.0.0.0", args.port), app)
+        serve_workers(http_server)  # Production Mode, several workers
     else:
         print("[INFO] Initializing server...")
-        http_server = WSGIServer(("0.0.0.0", 80), app)  # Production Mode
-        http_server.serve_forever()
\ No newline at end of file
+        start_worker()
+        gevent.spawn(broadcaster)
+        http_server = WSGIServer(("0.0.0.0", args.port), app)  # Production Mode
+        http_server.serve_forever()
@@ -0,0 +1,182 @@
+# metrics.py
+# In charge of counting and timing what the client, the socket server and the webserver do,
+# and serving it in the Prometheus text format on a local HTTP port
+#
+# Metrics are made once at module level and recorded on the hot path:
+#   FRAMES = metrics.Counter("client_frames_total", "Frames captured")
+#   FRAMES.inc()
+#   STAGE = metrics.Histogram("client_stage_seconds", "Time spent per stage", ("stage",))
+#   with STAGE.time("capture"): ...
+# Recording is a dict lookup, a bisect and a few additions under a lock,
+# everything else is done when /metrics is scraped
+
+# Libraries
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds, from a fast socket write to a slow inference on the Pi
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Every metric made so far, in order, served by /metrics
+REGISTRY = []
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labelNames, labelValues, extra=""):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(labelNames, labelValues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# Base Metric Class
+# Values are kept per tuple of label values, in the order of labelNames
+# With function, values are read when scraped instead, for stats kept elsewhere
+# function returns {label values: value}, or a single value without labels
+class Metric:
+    kind = None
+
+    def __init__(self, name : str, help : str, labelNames=(), function=None):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.function = function
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        if self.function is not None:
+            values = self.function()
+            values = {labelValues if isinstance(labelValues, tuple) else (labelValues,): value for labelValues, value in values.items()} if isinstance(values, dict) else {(): values}
+        else:
+            with self.lock:
+                values = dict(self.values)
+
+        for labelValues, value in sorted(values.items()):
+            lines.append(f"{self.name}{format_labels(self.labelNames, labelValues)} {value}")
+        return lines
+
+
+# Counter Class, only goes up
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labelValues, amount=1):
+        with self.lock:
+            self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+
+# Gauge Class, set to the latest value
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *labelValues):
+        with self.lock:
+            self.values[labelValues] = value
+
+    def inc(self, *labelValues, amount=1):
+        with self.lock:
+            self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+    def dec(self, *labelValues, amount=1):
+        self.inc(*labelValues, amount=-amount)
+
+
+# Histogram Class
+# Observations are counted in the first bucket they fit in, buckets are made cumulative when scraped
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name : str, help : str, labelNames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelNames)
+        self.buckets = tuple(buckets)
+
+    # Record an observation, usually seconds
+    def observe(self, value : float, *labelValues):
+        i = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            entry = self.values.get(labelValues)
+            if entry is None:
+                entry = self.values[labelValues] = [[0] * (len(self.buckets) + 1), 0.0]
+
+            entry[0][i] += 1
+            entry[1] += value
+
+    # Context manager recording the seconds spent in it
+    def time(self, *labelValues):
+        return Timer(self, labelValues)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            values = {labelValues: (list(counts), total) for labelValues, (counts, total) in self.values.items()}
+
+        for labelValues, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labelNames, labelValues, le)} {cumulative}")
+
+            lines.append(f"{self.name}_sum{format_labels(self.labelNames, labelValues)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelNames, labelValues)} {cumulative}")
+        return lines
+
+
+class Timer:
+    __slots__ = ("histogram", "labelValues", "start")
+
+    def __init__(self, histogram : Histogram, labelValues):
+        self.histogram = histogram
+        self.labelValues = labelValues
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labelValues)
+
+
+# Every metric in the Prometheus text format
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes are not worth a log line
+
+
+# Serve /metrics on a port from a background thread, returns the server
+def start_server(port : int, host="127.0.0.1"):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,119 @@
+# registry.py
+# In charge of loading the stall registry (stalls.json), the single list of
+# canteens and stalls shared by the client, the socket server and the webserver
+#
+# Every stall has an ID that is unique across all canteens (it is the stall ID of the
+# binary protocol), a name that is unique within its canteen, the service time per
+# customer in seconds and optionally the polygon of its queue in the camera image
+# The first canteen is the default, for clients and requests that do not name one
+
+# Libraries
+import json
+import os
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stalls.json")
+MAX_STALL_ID = 0xFFFF  # Stall IDs are 16 bit on the wire
+
+
+class RegistryError(Exception):
+    pass
+
+
+# Check a queue polygon is four [x, y] number pairs, as the perspective warp and full frame mode need
+def check_polygon(polygon, where : str):
+    if polygon is None:
+        return None
+
+    def is_number(value):
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+    if not isinstance(polygon, list) or len(polygon) != 4 or not all(isinstance(point, list) and len(point) == 2 and all(is_number(v) for v in point) for point in polygon):
+        raise RegistryError(f"Invalid polygon for {where}, needs four [x, y] points: {polygon!r}")
+
+    return polygon
+
+
+# Single stall, never changed after loading
+class Stall:
+    __slots__ = ("stallId", "canteen", "name", "serviceTime", "polygon", "textName")
+
+    def __init__(self, stallId : int, canteen : str, name : str, serviceTime : float, polygon, textName : str):
+        self.stallId = stallId
+        self.canteen = canteen
+        self.name = name
+        self.serviceTime = serviceTime
+        self.polygon = polygon          # [[x, y], ...] or None
+        self.textName = textName        # Name in "password|stall|time" reports, "canteen/stall" outside the default canteen
+
+    def __repr__(self):
+        return f"Stall({self.stallId}, {self.canteen!r}, {self.name!r})"
+
+
+# Stall Registry Class
+# Built once from stalls.json, every lookup is a dict lookup
+class Registry:
+    def __init__(self, data : dict):
+        self.canteens = {}  # Canteen name -> list of stalls, in display order
+        self.byId = {}      # Stall ID -> stall
+        self.byName = {}    # (canteen name, stall name) -> stall
+        self.byTextName = {}
+
+        canteens = data.get("canteens") if isinstance(data, dict) else None
+        if not canteens:
+            raise RegistryError("No canteens in registry")
+
+        self.defaultCanteen = canteens[0]["name"]
+
+        for canteen in canteens:
+            canteenName = canteen["name"]
+            if canteenName in self.canteens or "/" in canteenName:
+                raise RegistryError("Duplicate or invalid canteen name: " + canteenName)
+
+            self.canteens[canteenName] = []
+            for entry in canteen["stalls"]:
+                stallId = int(entry["id"])
+                name = entry["name"]
+
+                if not 0 <= stallId <= MAX_STALL_ID or stallId in self.byId:
+                    raise RegistryError("Duplicate or invalid stall ID: " + str(stallId))
+                if (canteenName, name) in self.byName:
+                    raise RegistryError(f"Duplicate stall name: {canteenName}/{name}")
+
+                textName = name if canteenName == self.defaultCanteen else f"{canteenName}/{name}"
+                polygon = check_polygon(entry.get("polygon"), f"{canteenName}/{name}")
+                stall = Stall(stallId, canteenName, name, float(entry.get("service_time", 120)), polygon, textName)
+
+                self.canteens[canteenName].append(stall)
+                self.byId[stallId] = stall
+                self.byName[(canteenName, name)] = stall
+                self.byTextName[textName] = stall
+
+    # Stall by canteen and name, canteen None for the default canteen, None if unknown
+    def stall(self, canteen, name : str):
+        return self.byName.get((canteen or self.defaultCanteen, name))
+
+    # Stall by its name in "password|stall|time" reports, None if unknown
+    def lookup(self, textName : str):
+        return self.byTextName.get(textName)
+
+    # Stalls of a canteen, canteen None for the default canteen, None if unknown
+    def stalls(self, canteen=None):
+        return self.canteens.get(canteen or self.defaultCanteen)
+
+
+# Registries loaded so far, path -> registry, so every file is only read once per process
+_registries = {}
+
+
+# Load a registry, stalls.json next to this file by default
+def load_registry(path=None):
+    path = os.path.abspath(path or DEFAULT_PATH)
+
+    if path not in _registries:
+        try:
+            with open(path, "r") as f:
+                _registries[path] = Registry(json.load(f))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            raise RegistryError(f"Failed to load stall registry {path}: {e}")
+
+    return _registries[path]
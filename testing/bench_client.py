@@ -0,0 +1,260 @@
+# End-to-end benchmark for backend/client.py
+# Drives capture -> cutImage -> countPeople -> getQueueTime -> send
+# against a local stand-in socket server, and reports per-stage latency
+# percentiles, frames per second and peak RSS
+
+import argparse
+import glob
+import json
+import os
+import resource
+import socketserver
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../backend"))
+
+parser = argparse.ArgumentParser(description='End-to-end benchmark for the Canteen Queue Counter client')
+parser.add_argument('--source', type=str, default="synthetic", choices=["synthetic", "folder", "video"], help='Where frames come from')
+parser.add_argument('--path', type=str, default=os.path.dirname(__file__), help='Image folder or video file for the folder / video sources')
+parser.add_argument('--resolution', type=str, default="320x240", help='Resolution of synthetic frames')
+parser.add_argument('--frames', type=int, default=50, help='Number of frames to time')
+parser.add_argument('--warmup', type=int, default=3, help='Number of untimed frames to run first')
+parser.add_argument('--queues', type=int, default=1, help='Number of queues to run on every frame')
+parser.add_argument('--batch', default=False, action="store_true", help='Count all queues with a single batched inference')
+parser.add_argument('--protocol', type=str, default="binary", choices=["binary", "text"], help='Wire protocol between the client and the stand-in server')
+parser.add_argument('--backend', type=str, default="torch", help='Inference backend')
+parser.add_argument('--model', type=str, default=None, help='Path to the model file for the chosen backend')
+parser.add_argument('--json', type=str, default=None, help='File to write results to, as JSON')
+parser.add_argument('--baseline', type=str, default=None, help='JSON results of a previous run to compare against')
+parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed slowdown against the baseline before failing (0.1 = 10%%)')
+args = parser.parse_args()
+
+import client
+import protocol
+from registry import Stall
+
+STAGES = ["capture", "cut", "count", "queue_time", "send"]
+
+
+# Frame Sources
+# Each source returns BGR frames forever from read()
+class SyntheticSource:
+    def __init__(self, resolution):
+        self.width, self.height = [int(v) for v in resolution.split("x")]
+        self.rng = np.random.default_rng(0)
+        self.frame = 0
+
+    def read(self):
+        image = self.rng.integers(0, 40, (self.height, self.width, 3), dtype=np.uint8)
+
+        # A few moving blobs, so frames differ like a real scene
+        for i in range(8):
+            x = (self.frame * (i + 1) * 3 + i * 37) % self.width
+            y = (i * self.height) // 8
+            cv2.circle(image, (x, y), 10, (200, 180, 160), -1)
+
+        self.frame += 1
+        return image
+
+
+class FolderSource:
+    def __init__(self, folder):
+        paths = []
+        for ext in ("*.jpg", "*.jpeg", "*.png"):
+            paths += glob.glob(os.path.join(folder, ext))
+
+        self.images = [cv2.imread(path) for path in sorted(paths)]
+        if not self.images:
+            raise ValueError("No images found in " + folder)
+        self.index = 0
+
+    def read(self):
+        image = self.images[self.index % len(self.images)]
+        self.index += 1
+        return image
+
+
+class VideoSource:
+    def __init__(self, path):
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise ValueError("Could not open video " + path)
+
+    def read(self):
+        ret, image = self.capture.read()
+        if not ret:  # Loop video
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, image = self.capture.read()
+
+        return image
+
+
+# Stand-in for the original backend/server.py, ACKs the single report of every connection
+class AckHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        if self.request.recv(1024):
+            self.request.sendall(b"ACK")
+
+
+# Stand-in for backend/server.py on the binary protocol: handshake, then every report with a valid tag is ACKed
+class BinaryAckHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        decoder = protocol.FrameDecoder()
+        client_nonce = server_nonce = key = None
+
+        while True:
+            data = self.request.recv(4096)
+            if not data:
+                return
+
+            reply = b""
+            for frame_type, payload in decoder.feed(data):
+                if frame_type == protocol.HELLO:
+                    client_nonce, server_nonce = payload, protocol.new_nonce()
+                    reply += protocol.encode_frame(protocol.CHALLENGE, server_nonce)
+                elif frame_type == protocol.AUTH:
+                    key = protocol.session_key(client.password, client_nonce, server_nonce)
+                    reply += protocol.encode_frame(protocol.WELCOME)
+                elif frame_type == protocol.REPORT_FRAME:
+                    reply += protocol.encode_ack(protocol.decode_report(key, payload)[4])
+
+            self.request.sendall(reply)
+
+
+def start_server():
+    handler = BinaryAckHandler if args.protocol == "binary" else AckHandler
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+# Run one frame through the pipeline, returns time spent in every stage
+def run_frame(source, queues):
+    timings = dict.fromkeys(STAGES, 0.0)
+
+    start = time.perf_counter()
+    image = source.read()
+    timings["capture"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for queue in queues:
+        queue.image = image
+        queue.cutImage()
+    timings["cut"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if args.batch:
+        counts = client.count_people_batch(queues)
+    else:
+        counts = [queue.countPeople() for queue in queues]
+    timings["count"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for queue, count in zip(queues, counts):
+        queue.getQueueTime(count)
+    timings["queue_time"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    client.send_queue_times(queues, counts)
+    if not client.connection.flush(timeout=10):
+        raise RuntimeError("Stand-in server did not ACK")
+    timings["send"] = time.perf_counter() - start
+
+    return timings
+
+
+def main():
+    if args.source == "folder":
+        source = FolderSource(args.path)
+    elif args.source == "video":
+        source = VideoSource(args.path)
+    else:
+        source = SyntheticSource(args.resolution)
+
+    server = start_server()
+    # Benchmark queues are not in the registry, so they get stalls of their own for the binary stall IDs
+    polygon = [[0,0],[650, 0],[650,400],[0,500]]
+    stalls = {f"Queue {i}": Stall(i, "bench", f"Queue {i}", 120, polygon, f"Queue {i}") for i in range(args.queues)}
+    client.connection = client.Connection(*server.server_address, client.password, stalls, binary=args.protocol == "binary")
+    client.connection.start()
+
+    # Load model the same way the client does
+    client.model = client.ModelLoader(args.backend, args.model, yolov5Dir=client.args.yolov5_dir, warmupShape=(client.H, client.W, 3))
+    client.model.start()
+    if not client.model.wait():
+        print("[FATAL] Failed to load model!")
+        print("Error Log: " + str(client.model.error))
+        sys.exit(1)
+
+    queues = [client.Queue(stall.name, stall.serviceTime, stall.polygon) for stall in stalls.values()]
+
+    for _ in range(args.warmup):
+        run_frame(source, queues)
+
+    samples = {stage: [] for stage in STAGES}
+    start = time.perf_counter()
+    for _ in range(args.frames):
+        for stage, seconds in run_frame(source, queues).items():
+            samples[stage].append(seconds * 1000)
+    elapsed = time.perf_counter() - start
+
+    results = {
+        "fps": args.frames / elapsed,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": {},
+    }
+
+    print(f"{'Stage':<12}{'mean':>10}{'p50':>10}{'p90':>10}{'p99':>10}   (ms)")
+    for stage in STAGES + ["total"]:
+        values = np.array(samples[stage]) if stage != "total" else np.sum([samples[s] for s in STAGES], axis=0)
+        results["stages"][stage] = {
+            "mean": float(values.mean()),
+            "p50": float(np.percentile(values, 50)),
+            "p90": float(np.percentile(values, 90)),
+            "p99": float(np.percentile(values, 99)),
+        }
+        r = results["stages"][stage]
+        print(f"{stage:<12}{r['mean']:>10.2f}{r['p50']:>10.2f}{r['p90']:>10.2f}{r['p99']:>10.2f}")
+
+    print(f"\n{results['fps']:.2f} frames/s, peak RSS {results['peak_rss_mb']:.1f} MB")
+    server.shutdown()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    # Fail on regressions against a previous run
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+
+        regressions = []
+        for stage, r in results["stages"].items():
+            old = baseline["stages"].get(stage)
+            if old and r["p50"] > old["p50"] * (1 + args.tolerance):
+                regressions.append(f"{stage}: p50 {old['p50']:.2f} -> {r['p50']:.2f} ms")
+
+        if results["fps"] < baseline["fps"] * (1 - args.tolerance):
+            regressions.append(f"fps: {baseline['fps']:.2f} -> {results['fps']:.2f}")
+
+        if regressions:
+            print("\n[ERROR] Regressions against baseline:")
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+
+        print("\n[INFO] No regressions against baseline")
+
+
+# Run
+if __name__ == "__main__":
+    main()
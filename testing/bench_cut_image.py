@@ -0,0 +1,55 @@
+# Micro-benchmark for Queue.cutImage
+# Compares the old per-frame getPerspectiveTransform + warpPerspective
+# against the precomputed remap table in backend/warp.py
+
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../backend"))
+from warp import Warp
+
+parser = argparse.ArgumentParser(description='Benchmark for Queue.cutImage')
+parser.add_argument('--image', type=str, default=os.path.join(os.path.dirname(__file__), "queue_2.jpg"), help='Image to cut')
+parser.add_argument('--iterations', type=int, default=500, help='Number of cuts to time')
+args = parser.parse_args()
+
+W, H = 640, 640
+positions = [[0,0],[650, 0],[650,400],[0,500]]
+
+img = cv2.imread(args.image)
+
+
+# Old cutImage path
+def cut_warp_perspective(img):
+    pts0 = np.float32(positions)
+    pts1 = np.float32([[0,0],[W,0],[W,H],[0,H]])
+    M = cv2.getPerspectiveTransform(pts0, pts1)
+    return cv2.warpPerspective(img, M, (W, H))
+
+
+def bench(name, func):
+    func()  # Warm up
+    times = []
+    for _ in range(args.iterations):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    times = np.array(times) * 1000
+    print(f"{name:<20} mean {times.mean():7.3f} ms   p50 {np.percentile(times, 50):7.3f} ms   p99 {np.percentile(times, 99):7.3f} ms")
+
+
+start = time.perf_counter()
+warp = Warp(positions, W, H)
+print(f"Remap table built in {(time.perf_counter() - start) * 1000:.3f} ms")
+
+bench("warpPerspective", lambda: cut_warp_perspective(img))
+bench("remap table", lambda: warp.apply(img))
+
+diff = np.abs(cut_warp_perspective(img).astype(np.int16) - warp.apply(img).astype(np.int16))
+print(f"Max pixel difference: {diff.max()}, mean: {diff.mean():.4f}")
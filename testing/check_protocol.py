@@ -0,0 +1,84 @@
+# Round-trip check for backend/protocol.py
+# Encodes a handshake and reports, feeds them to FrameDecoder split at every byte and
+# coalesced into one read, and checks that tampered reports and bad frames are rejected
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../backend"))
+import protocol
+
+
+def feed_all(chunks):
+    decoder = protocol.FrameDecoder()
+    frames = []
+    for chunk in chunks:
+        frames += decoder.feed(chunk)
+    return frames, decoder
+
+
+def main():
+    client_nonce, server_nonce = protocol.new_nonce(), protocol.new_nonce()
+    key = protocol.session_key("password", client_nonce, server_nonce)
+
+    reports = [(3, 5, 600, 1700000000, 1), (7, 0, 0, 1700000001, 2), (0xFFFF, 70000, 70000, 1700000002, 3)]
+    stream = protocol.encode_frame(protocol.HELLO, client_nonce)
+    stream += protocol.encode_frame(protocol.AUTH, protocol.auth_mac("password", client_nonce, server_nonce))
+    stream += b"".join(protocol.encode_report(key, *report) for report in reports)
+
+    expected = [(3, 5, 600, 1700000000, 1), (7, 0, 0, 1700000001, 2), (0xFFFF, 0xFFFF, 0xFFFF, 1700000002, 3)]
+
+    # Partial reads, a byte at a time, and coalesced reads, everything at once
+    for name, chunks in (("partial", [stream[i:i + 1] for i in range(len(stream))]), ("coalesced", [stream])):
+        frames, decoder = feed_all(chunks)
+        assert [frame_type for frame_type, _ in frames] == [protocol.HELLO, protocol.AUTH] + [protocol.REPORT_FRAME] * 3, name
+        assert frames[0][1] == client_nonce, name
+        assert [protocol.decode_report(key, payload) for _, payload in frames[2:]] == expected, name
+        assert decoder.buffer == b"", name
+        print(f"[INFO] {name} reads OK")
+
+    # A frame cut short stays buffered until the rest arrives
+    frames, decoder = feed_all([stream[:-1]])
+    assert len(frames) == 4 and decoder.feed(stream[-1:])[0][0] == protocol.REPORT_FRAME
+
+    # Tampered payloads, tags and other session keys are rejected
+    payload = protocol.encode_report(key, *reports[0])[protocol.HEADER.size:]
+    other_key = protocol.session_key("password", server_nonce, client_nonce)
+    for bad_key, bad_payload in ((key, bytes([payload[0] ^ 1]) + payload[1:]), (key, payload[:-1] + bytes([payload[-1] ^ 1])), (other_key, payload), (key, payload[:-1])):
+        try:
+            protocol.decode_report(bad_key, bad_payload)
+        except protocol.ProtocolError:
+            continue
+        raise AssertionError("Bad report accepted")
+    print("[INFO] Bad reports rejected")
+
+    # Bad headers and oversized frames are rejected
+    for bad in (b"XX" + stream[2:protocol.HEADER.size], protocol.HEADER.pack(protocol.MAGIC, protocol.VERSION, protocol.REPORT_FRAME, protocol.MAX_PAYLOAD + 1)):
+        try:
+            protocol.FrameDecoder().feed(bad)
+        except protocol.ProtocolError:
+            continue
+        raise AssertionError("Bad frame accepted")
+    print("[INFO] Bad frames rejected")
+
+    # Short ACKs are bad frames, ERRORs carry the sequence number of the rejected report and the reason
+    try:
+        protocol.decode_ack(b"\x00\x01")
+        raise AssertionError("Short ACK accepted")
+    except protocol.ProtocolError:
+        pass
+    assert protocol.decode_error(protocol.encode_error(9, "Bad timestamp")[protocol.HEADER.size:]) == (9, "Bad timestamp")
+    assert protocol.decode_error(b"") == (None, "")
+    print("[INFO] ACK and ERROR frames OK")
+
+    # ACKs and timestamps across the 32 bit wrap around
+    assert protocol.decode_ack(protocol.encode_ack(2**32 + 5)[protocol.HEADER.size:]) == 5
+    assert protocol.timestamp_skew(5, 2**32 - 5) == 10
+    assert protocol.timestamp_skew(2**32 - 5, 2**32 + 5) == -10
+
+    print("[INFO] All protocol checks passed")
+
+
+# Run
+if __name__ == "__main__":
+    main()
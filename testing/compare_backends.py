@@ -0,0 +1,109 @@
+# Latency / count comparison report across inference backends
+# Runs every exported model (see backend/export_model.py) over a folder of images
+# and writes a markdown report comparing latency and head counts to eager torch
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../backend"))
+from inference import BACKENDS, MODEL_FILES, load_backend
+from polygon import HEAD_CLASS
+
+parser = argparse.ArgumentParser(description='Inference backend comparison for Canteen Queue Counter')
+parser.add_argument('--images', type=str, default=os.path.dirname(__file__), help='Folder of images to run')
+parser.add_argument('--model_dir', type=str, default=os.path.join(os.path.dirname(__file__), "../backend"), help='Folder holding the exported models')
+parser.add_argument('--backends', type=str, default=",".join(BACKENDS), help='Comma separated list of backends to compare')
+parser.add_argument('--yolov5_dir', type=str, default=os.path.join(os.path.dirname(__file__), "../backend/yolov5"), help='Local yolov5 checkout, used to load the torch model offline like the client')
+parser.add_argument('--confidence_threshold', type=float, default=0.3, help='Minimum confidence for a head to be counted, as in the client')
+parser.add_argument('--repeat', type=int, default=5, help='Number of timed runs per image')
+parser.add_argument('--output', type=str, default=None, help='File to write the markdown report to')
+args = parser.parse_args()
+
+
+def load_images(folder):
+    paths = []
+    for ext in ("*.jpg", "*.jpeg", "*.png"):
+        paths += glob.glob(os.path.join(folder, ext))
+
+    return [(os.path.basename(path), cv2.imread(path)) for path in sorted(paths)]
+
+
+# Count heads the way client.count_heads does
+def count_heads(detections):
+    return int(np.count_nonzero((detections[:, 5] == HEAD_CLASS) & (detections[:, 4] >= args.confidence_threshold)))
+
+
+def run_backend(backend, images):
+    latencies = []
+    counts = []
+
+    for _, image in images:
+        backend.infer([image])  # Warm up
+
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            detections = backend.infer([image])[0]
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        counts.append(count_heads(detections))
+
+    return np.array(latencies), counts
+
+
+def main():
+    images = load_images(args.images)
+    if not images:
+        print("[FATAL] No images found in " + args.images)
+        sys.exit(1)
+
+    results = {}
+    for name in [b.strip() for b in args.backends.split(",") if b.strip()]:
+        path = os.path.join(args.model_dir, MODEL_FILES[name])
+        try:
+            backend = load_backend(name, path, yolov5Dir=args.yolov5_dir)
+        except Exception as e:
+            print(f"[ERROR] Skipping {name}: {e}")
+            continue
+
+        print(f"[INFO] Running {name}...")
+        results[name] = run_backend(backend, images)
+
+    reference = results.get("torch", next(iter(results.values()), None))
+    if reference is None:
+        print("[FATAL] No backend could be loaded")
+        sys.exit(1)
+
+    lines = ["# Inference backend comparison", ""]
+    lines.append(f"{len(images)} images, {args.repeat} runs each, batch size 1")
+    lines.append("")
+    lines.append("| Backend | Mean (ms) | p50 (ms) | p99 (ms) | Speedup | Max count diff | Mean count diff |")
+    lines.append("|---|---|---|---|---|---|---|")
+
+    for name, (latencies, counts) in results.items():
+        diff = np.abs(np.array(counts) - np.array(reference[1]))
+        lines.append(f"| {name} | {latencies.mean():.1f} | {np.percentile(latencies, 50):.1f} | {np.percentile(latencies, 99):.1f} "
+                     f"| {reference[0].mean() / latencies.mean():.2f}x | {diff.max()} | {diff.mean():.2f} |")
+
+    lines.append("")
+    lines.append("| Image | " + " | ".join(results) + " |")
+    lines.append("|---|" + "---|" * len(results))
+    for i, (filename, _) in enumerate(images):
+        lines.append(f"| {filename} | " + " | ".join(str(counts[i]) for _, counts in results.values()) + " |")
+
+    report = "\n".join(lines)
+    print(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+
+
+# Run
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,597 @@
+# Load generator for the central box
+# Runs a fleet of simulated Pis speaking the binary protocol of client.py (see backend/protocol.py)
+# to backend/server.py, and simulated browsers polling /api/get_timing and loading / from
+# frontend/webserver.py, then reports throughput, latency percentiles, error rates and
+# the CPU and RSS of both servers, read from /proc
+#
+# Both servers are started here on local ports, the socket server forwarding to the webserver,
+# so the whole path from the Pis to the browsers is under load:
+#   python load_fleet.py --clients 200 --report_interval 5 --browsers 100 --duration 120
+# Fault injection:
+#   --slow_clients 0.1      a tenth of the clients write every frame a few bytes at a time
+#   --drop_acks 0.05        ACKs are ignored with this probability, the client reconnects and
+#                           sends its unACKed reports again after --ack_timeout
+#   --webserver_down 30:20  the webserver is stopped 30 seconds into the run, for 20 seconds
+
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../backend"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../misc"))
+import protocol
+from registry import RegistryError, load_registry
+
+parser = argparse.ArgumentParser(description='Load generator for the Canteen Queue Counter socket server and webserver')
+parser.add_argument('--clients', type=int, default=100, help='Number of simulated Pis')
+parser.add_argument('--stalls_per_client', type=int, default=1, help='Stalls every simulated Pi reports, taken from the registry in turn')
+parser.add_argument('--report_interval', type=float, default=30, help='Seconds between reports of a simulated Pi')
+parser.add_argument('--browsers', type=int, default=20, help='Number of simulated browsers')
+parser.add_argument('--poll_interval', type=float, default=30, help='Seconds between requests of a simulated browser')
+parser.add_argument('--index_ratio', type=float, default=0.1, help='Fraction of browser requests loading the page instead of polling /api/get_timing')
+parser.add_argument('--duration', type=float, default=60, help='Seconds to run for')
+parser.add_argument('--slow_clients', type=float, default=0, help='Fraction of clients writing every frame a few bytes at a time')
+parser.add_argument('--slow_chunk', type=int, default=4, help='Bytes slow clients write at a time')
+parser.add_argument('--slow_delay', type=float, default=0.05, help='Seconds slow clients wait between writes')
+parser.add_argument('--drop_acks', type=float, default=0, help='Probability that a client ignores an ACK')
+parser.add_argument('--ack_timeout', type=float, default=10, help='Seconds a client waits for an ACK before reconnecting and sending again')
+parser.add_argument('--webserver_down', type=str, default=None, help='START:DURATION, seconds into the run to stop the webserver at and for how long')
+parser.add_argument('--registry', type=str, default=None, help='Stall registry file, misc/stalls.json by default')
+parser.add_argument('--host', type=str, default="127.0.0.1", help='Host of both servers')
+parser.add_argument('--server_port', type=int, default=16942, help='Port of the socket server')
+parser.add_argument('--web_port', type=int, default=18080, help='Port of the webserver')
+parser.add_argument('--server_metrics_port', type=int, default=19102, help='Metrics port of the socket server, scraped for report and forwarder counts, 0 to skip')
+parser.add_argument('--state', type=str, default="local", help='State backend of the webserver')
+parser.add_argument('--workers', type=int, default=1, help='Worker processes of the webserver')
+parser.add_argument('--external', default=False, action="store_true", help='Load servers that are already running instead of starting them')
+parser.add_argument('--server_pid', type=int, default=None, help='PID of the socket server with --external, for CPU and RSS')
+parser.add_argument('--webserver_pid', type=int, default=None, help='PID of the webserver with --external, for CPU and RSS')
+parser.add_argument('--seed', type=int, default=0, help='Seed of the simulated fleet')
+parser.add_argument('--json', type=str, default=None, help='File to write results to, as JSON')
+args = parser.parse_args()
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# Read credentials, the same file the servers read
+credentials = {}
+with open(os.path.join(ROOT, "misc/credentials.txt"), "r") as f:
+    for line in f:
+        key, val = line.split("=")
+        credentials[key] = val.strip("\n")
+
+password = credentials["password"]
+
+
+# Results of a simulated process: latencies in ms per operation, and counts per event
+def new_results():
+    return {"latencies": {}, "counts": {}}
+
+
+def observe(results, name, ms):
+    results["latencies"].setdefault(name, []).append(ms)
+
+
+def count(results, name, amount=1):
+    results["counts"][name] = results["counts"].get(name, 0) + amount
+
+
+def merge(results, other):
+    for name, values in other["latencies"].items():
+        results["latencies"].setdefault(name, []).extend(values)
+    for name, amount in other["counts"].items():
+        count(results, name, amount)
+
+
+# Simulated Pi Class
+# Connects and reports like backend/connection.py: one connection, the handshake, then every
+# report interval one write with a report per stall, ACKs matched by sequence number
+# Reports still unACKed after a reconnect are sent again
+class SimulatedPi:
+    def __init__(self, index : int, stalls, results, slow : bool):
+        self.stalls = stalls
+        self.results = results
+        self.slow = slow
+        self.random = random.Random(args.seed + index)
+        self.seq = itertools.count(1)
+        self.pending = {}  # Sequence number -> (report, perf counter when sent)
+
+    async def write(self, writer, data : bytes):
+        if not self.slow:
+            writer.write(data)
+            await writer.drain()
+            return
+
+        for i in range(0, len(data), args.slow_chunk):
+            writer.write(data[i:i + args.slow_chunk])
+            await writer.drain()
+            await asyncio.sleep(args.slow_delay)
+
+    async def readFrame(self, reader, decoder):
+        while True:
+            data = await reader.read(1024)
+            if not data:
+                raise protocol.ProtocolError("Connection closed during handshake")
+
+            frames = decoder.feed(data)
+            if frames:
+                return frames[0]
+
+    # Connect and authenticate, returns the reader, writer, frame decoder and session key
+    async def connect(self):
+        start = time.perf_counter()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(args.host, args.server_port), 10)
+
+        try:
+            decoder = protocol.FrameDecoder()
+            clientNonce = protocol.new_nonce()
+            await self.write(writer, protocol.encode_frame(protocol.HELLO, clientNonce))
+
+            frameType, serverNonce = await asyncio.wait_for(self.readFrame(reader, decoder), 10)
+            if frameType != protocol.CHALLENGE or len(serverNonce) != protocol.NONCE_SIZE:
+                raise protocol.ProtocolError("Expected CHALLENGE")
+
+            await self.write(writer, protocol.encode_frame(protocol.AUTH, protocol.auth_mac(password, clientNonce, serverNonce)))
+
+            frameType, _ = await asyncio.wait_for(self.readFrame(reader, decoder), 10)
+            if frameType != protocol.WELCOME:
+                raise protocol.ProtocolError("Authentication rejected by server")
+        except BaseException:
+            writer.close()
+            raise
+
+        observe(self.results, "connect", (time.perf_counter() - start) * 1000)
+        return reader, writer, decoder, protocol.session_key(password, clientNonce, serverNonce)
+
+    # Match ACKs to sent reports until the connection is closed
+    async def readAcks(self, reader, decoder):
+        while True:
+            try:
+                data = await reader.read(4096)
+                frames = decoder.feed(data)
+            except (OSError, protocol.ProtocolError):
+                return
+
+            if not data:
+                return
+
+            for frameType, payload in frames:
+                if frameType != protocol.ACK_FRAME:
+                    continue
+
+                if self.random.random() < args.drop_acks:
+                    count(self.results, "dropped_acks")
+                    continue
+
+                entry = self.pending.pop(protocol.decode_ack(payload), None)
+                if entry is not None:
+                    count(self.results, "acked")
+                    observe(self.results, "ack", (time.perf_counter() - entry[1]) * 1000)
+
+    def newReport(self, stall):
+        people = self.random.randint(0, 20)
+        return stall.stallId, people, people * stall.serviceTime
+
+    # Send reports every report interval over one connection
+    # Returns to reconnect when a report is not ACKed in time, raises ConnectionError when the server closes it
+    async def report(self, writer, key : bytes, ackReader, deadline : float):
+        resend = [report for report, _ in self.pending.values()]
+        self.pending.clear()
+        nextReport = time.monotonic()
+
+        while True:
+            reports = resend or [self.newReport(stall) for stall in self.stalls]
+            resend = []
+
+            data = b""
+            sentAt = time.perf_counter()
+            for stallId, people, waitSecs in reports:
+                seq = next(self.seq)
+                data += protocol.encode_report(key, stallId, people, waitSecs, int(time.time()), seq)
+                self.pending[seq] = ((stallId, people, waitSecs), sentAt)
+
+            await self.write(writer, data)
+            count(self.results, "sent", len(reports))
+
+            # Wait for the next report, watching for ACK timeouts and the server closing the connection
+            nextReport += args.report_interval
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    return
+                if ackReader.done():
+                    raise ConnectionError("Connection closed by server")
+
+                expired = sum(1 for _, sent in self.pending.values() if time.perf_counter() - sent > args.ack_timeout)
+                if expired:
+                    count(self.results, "ack_timeouts", expired)
+                    return
+
+                if now >= nextReport:
+                    break
+                await asyncio.sleep(min(0.5, nextReport - now, deadline - now))
+
+    async def run(self, deadline : float):
+        await asyncio.sleep(self.random.uniform(0, args.report_interval))  # Pis are not in step with each other
+        backoff = 1
+
+        while time.monotonic() < deadline:
+            try:
+                reader, writer, decoder, key = await self.connect()
+            except (OSError, asyncio.TimeoutError, protocol.ProtocolError):
+                count(self.results, "connect_errors")
+                await asyncio.sleep(min(backoff, max(0, deadline - time.monotonic())))
+                backoff = min(backoff * 2, 30)
+                continue
+
+            backoff = 1
+            ackReader = asyncio.ensure_future(self.readAcks(reader, decoder))
+
+            try:
+                await self.report(writer, key, ackReader, deadline)
+            except (OSError, ConnectionError):
+                count(self.results, "disconnects")
+            finally:
+                ackReader.cancel()
+                writer.close()
+
+
+# Fleet process, every simulated Pi on one event loop
+def run_fleet(stalls, deadline : float, results_queue):
+    results = new_results()
+    rng = random.Random(args.seed)
+
+    pis = []
+    for i in range(args.clients):
+        pi_stalls = [stalls[(i * args.stalls_per_client + j) % len(stalls)] for j in range(args.stalls_per_client)]
+        pis.append(SimulatedPi(i, pi_stalls, results, rng.random() < args.slow_clients))
+
+    async def run_all():
+        await asyncio.gather(*(pi.run(deadline) for pi in pis))
+
+    asyncio.run(run_all())
+
+    count(results, "unacked_at_end", sum(len(pi.pending) for pi in pis))
+    results_queue.put(("fleet", results))
+
+
+# Simulated browser, requests a page or the timings of its canteen every poll interval
+# ETags are kept and sent back like a browser cache would, so unchanged timings are 304s
+def run_browser(index : int, canteen : str, path : str, deadline : float, results):
+    rng = random.Random(args.seed + 100000 + index)
+    session = requests.Session()
+    etags = {}
+    base = f"http://{args.host}:{args.web_port}"
+
+    time.sleep(min(rng.uniform(0, args.poll_interval), max(0, deadline - time.monotonic())))
+
+    while time.monotonic() < deadline:
+        if rng.random() < args.index_ratio:
+            name, url = "index", base + path
+        else:
+            name, url = "get_timing", f"{base}/api/get_timing?stall_name=all&canteen={canteen}"
+
+        headers = {"If-None-Match": etags[url]} if url in etags else {}
+        start = time.perf_counter()
+        try:
+            response = session.get(url, headers=headers, timeout=10)
+            if response.status_code in (200, 304):
+                observe(results, name, (time.perf_counter() - start) * 1000)
+                count(results, name + "_ok")
+                if response.status_code == 304:
+                    count(results, "not_modified")
+                if "ETag" in response.headers:
+                    etags[url] = response.headers["ETag"]
+            else:
+                count(results, name + "_errors")
+        except requests.RequestException:
+            count(results, name + "_errors")
+
+        time.sleep(min(args.poll_interval, max(0, deadline - time.monotonic())))
+
+
+# Browser process, a thread per simulated browser, spread over the canteens
+def run_browsers(canteens, defaultCanteen : str, deadline : float, results_queue):
+    results = [new_results() for _ in range(args.browsers)]
+    threads = []
+
+    for i in range(args.browsers):
+        canteen = canteens[i % len(canteens)]
+        path = "/" if canteen == defaultCanteen else "/canteen/" + canteen
+
+        thread = threading.Thread(target=run_browser, args=(i, canteen, path, deadline, results[i]))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    merged = new_results()
+    for browser_results in results:
+        merge(merged, browser_results)
+    results_queue.put(("browsers", merged))
+
+
+# PIDs of a process and all its descendants, e.g. forked webserver workers
+def process_tree(pid : int):
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    pids = [pid]
+    for p in pids:
+        pids += children.get(p, [])
+    return pids
+
+
+# CPU seconds and RSS bytes of a process and its descendants
+# RSS of forked workers is summed, so pages they share are counted more than once
+def usage(pid : int):
+    cpu = rss = 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/stat", "r") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS  # utime, stime
+            rss += int(fields[21]) * PAGE_SIZE
+        except (OSError, IndexError, ValueError):
+            pass
+    return cpu, rss
+
+
+# Usage Sampler Class
+# Samples CPU % and RSS of a process every time sample() is called, the PID may change on restarts
+class UsageSampler:
+    def __init__(self):
+        self.cpu = []
+        self.rss = []
+        self.last = None  # (pid, cpu seconds, monotonic time)
+
+    def sample(self, pid):
+        if pid is None or not os.path.exists(f"/proc/{pid}"):
+            self.last = None
+            return
+
+        cpu, rss = usage(pid)
+        now = time.monotonic()
+        if self.last is not None and self.last[0] == pid and now > self.last[2]:
+            self.cpu.append((cpu - self.last[1]) / (now - self.last[2]) * 100)
+        self.rss.append(rss / 1024 / 1024)
+        self.last = (pid, cpu, now)
+
+    def summary(self):
+        if not self.rss:
+            return None
+        return {
+            "cpu_mean": float(np.mean(self.cpu)) if self.cpu else 0.0,
+            "cpu_max": float(np.max(self.cpu)) if self.cpu else 0.0,
+            "rss_peak_mb": float(np.max(self.rss)),
+        }
+
+
+def start_process(script : str, options, directory : str, name : str, env=None):
+    command = [sys.executable, "-u", os.path.join(ROOT, script)] + options
+    if args.registry:
+        command += ["--registry", args.registry]
+
+    log = open(os.path.join(directory, name + ".log"), "a")
+    return subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, cwd=os.path.dirname(os.path.join(ROOT, script)), env=env)
+
+
+def start_webserver(directory : str):
+    options = ["--port", str(args.web_port), "--metrics_port", "0", "--history", os.path.join(directory, "history.db"),
+               "--state", args.state, "--workers", str(args.workers)]
+    # The webserver takes the key and token the socket server forwards with from the environment
+    env = dict(os.environ, QUEUE_AUTH_KEY=credentials["auth_key"], QUEUE_AUTH_TOKEN=credentials["auth_token"])
+    return start_process("frontend/webserver.py", options, directory, "webserver", env)
+
+
+def start_server(directory : str):
+    options = ["--no_gui", "--ip", args.host, "--port", str(args.server_port), "--url", f"http://{args.host}:{args.web_port}",
+               "--metrics_port", str(args.server_metrics_port), "--metrics_host", args.host]
+    return start_process("backend/server.py", options, directory, "server")
+
+
+def stop_process(process):
+    if process is None or process.poll() is not None:
+        return
+
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+# Wait for a server to accept connections, exits if it dies first
+def wait_for_port(port : int, process, name : str, directory : str, timeout=30):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if process is not None and process.poll() is not None:
+            print(f"[FATAL] {name} exited with status {process.returncode}, see {os.path.join(directory, name + '.log')}")
+            sys.exit(1)
+
+        try:
+            socket.create_connection((args.host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+
+    print(f"[FATAL] {name} did not start listening on port {port}")
+    sys.exit(1)
+
+
+# Counters of the socket server, from its metrics port
+def scrape_server():
+    try:
+        text = requests.get(f"http://{args.host}:{args.server_metrics_port}/metrics", timeout=5).text
+    except requests.RequestException:
+        return {}
+
+    values = {}
+    for line in text.splitlines():
+        if (line.startswith("server_reports_total") or line.startswith("forwarder_")) and "_seconds" not in line:
+            name, value = line.rsplit(" ", 1)
+            values[name] = float(value)
+    return values
+
+
+def summarize(latencies, ok : int, errors : int):
+    values = np.array(latencies) if latencies else np.zeros(1)
+    return {
+        "count": ok,
+        "per_second": ok / args.duration,
+        "errors": errors,
+        "error_rate": errors / (ok + errors) if ok + errors else 0.0,
+        "p50": float(np.percentile(values, 50)),
+        "p99": float(np.percentile(values, 99)),
+    }
+
+
+def main():
+    try:
+        registry = load_registry(args.registry)
+    except RegistryError as e:
+        print("[FATAL] " + str(e))
+        sys.exit(1)
+
+    down_start = down_end = None
+    if args.webserver_down:
+        if args.external:
+            print("[FATAL] --webserver_down needs the webserver to be started here, not --external")
+            sys.exit(1)
+        start, length = args.webserver_down.split(":")
+        down_start, down_end = float(start), float(start) + float(length)
+
+    # Every simulated Pi holds a socket
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
+
+    directory = tempfile.mkdtemp(prefix="load_fleet-")
+    webserver = server = None
+    pids = {"server": args.server_pid, "webserver": args.webserver_pid}
+
+    if not args.external:
+        print(f"[INFO] Starting servers, logs in {directory}")
+        webserver = start_webserver(directory)
+        wait_for_port(args.web_port, webserver, "webserver", directory)
+        server = start_server(directory)
+        wait_for_port(args.server_port, server, "server", directory)
+        pids = {"server": server.pid, "webserver": webserver.pid}
+
+    stalls = list(registry.byId.values())
+    offered = args.clients * args.stalls_per_client / args.report_interval
+    print(f"[INFO] {args.clients} clients offering {offered:.1f} reports/s, {args.browsers} browsers, {args.duration:.0f}s")
+
+    start_time = time.monotonic()
+    deadline = start_time + args.duration
+    results_queue = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=run_fleet, args=(stalls, deadline, results_queue)),
+        multiprocessing.Process(target=run_browsers, args=(list(registry.canteens), registry.defaultCanteen, deadline, results_queue)),
+    ]
+    for process in processes:
+        process.start()
+
+    samplers = {name: UsageSampler() for name in pids}
+    down = False
+    try:
+        while time.monotonic() < deadline:
+            elapsed = time.monotonic() - start_time
+
+            # Webserver fault
+            if down_start is not None and not down and down_start <= elapsed < down_end:
+                print(f"[INFO] Stopping webserver at {elapsed:.0f}s")
+                stop_process(webserver)
+                down = True
+            elif down and elapsed >= down_end:
+                print(f"[INFO] Starting webserver again at {elapsed:.0f}s")
+                webserver = start_webserver(directory)
+                wait_for_port(args.web_port, webserver, "webserver", directory)
+                pids["webserver"] = webserver.pid
+                down = False
+
+            for name, sampler in samplers.items():
+                sampler.sample(None if name == "webserver" and down else pids[name])
+            time.sleep(1)
+
+        # Simulated processes finish their last requests
+        collected = dict(results_queue.get(timeout=args.ack_timeout + 60) for _ in processes)
+        for process in processes:
+            process.join()
+
+        counters = scrape_server() if args.server_metrics_port else {}
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        stop_process(server)
+        stop_process(webserver)
+
+    fleet, browsers = collected["fleet"], collected["browsers"]
+    fleet_counts, browser_counts = fleet["counts"], browsers["counts"]
+    results = {
+        "operations": {
+            "connect": summarize(fleet["latencies"].get("connect"), len(fleet["latencies"].get("connect", [])), fleet_counts.get("connect_errors", 0)),
+            "report_ack": summarize(fleet["latencies"].get("ack"), fleet_counts.get("acked", 0), fleet_counts.get("ack_timeouts", 0)),
+            "get_timing": summarize(browsers["latencies"].get("get_timing"), browser_counts.get("get_timing_ok", 0), browser_counts.get("get_timing_errors", 0)),
+            "index": summarize(browsers["latencies"].get("index"), browser_counts.get("index_ok", 0), browser_counts.get("index_errors", 0)),
+        },
+        "fleet": fleet_counts,
+        "browsers": browser_counts,
+        "usage": {name: sampler.summary() for name, sampler in samplers.items()},
+        "server_counters": counters,
+    }
+
+    print(f"\n{'Operation':<14}{'count':>9}{'per s':>10}{'errors':>8}{'error %':>9}{'p50':>10}{'p99':>10}   (ms)")
+    for name, r in results["operations"].items():
+        print(f"{name:<14}{r['count']:>9}{r['per_second']:>10.2f}{r['errors']:>8}{r['error_rate'] * 100:>9.2f}{r['p50']:>10.2f}{r['p99']:>10.2f}")
+
+    print(f"\nReports sent {fleet_counts.get('sent', 0)}, ACKed {fleet_counts.get('acked', 0)}, ACKs dropped {fleet_counts.get('dropped_acks', 0)}, "
+          f"disconnects {fleet_counts.get('disconnects', 0)}, unACKed at end {fleet_counts.get('unacked_at_end', 0)}")
+    print(f"Browser responses not modified {browser_counts.get('not_modified', 0)}")
+
+    for name, summary in results["usage"].items():
+        if summary is None:
+            print(f"{name}: no CPU / RSS, no PID")
+        else:
+            print(f"{name}: CPU mean {summary['cpu_mean']:.1f}%, max {summary['cpu_max']:.1f}%, peak RSS {summary['rss_peak_mb']:.1f} MB")
+
+    for name, value in sorted(counters.items()):
+        print(f"{name} {value:g}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+# Run
+if __name__ == "__main__":
+    main()